@@ -0,0 +1,110 @@
+"""
+
+    File: analytics.py
+    Description:
+
+        Streaming hot-key statistics in bounded memory: which uris, query
+        parameters and elements account for requests, misses, stale
+        refreshes and backend time.
+
+"""
+
+from twisted.internet import reactor
+import zlib
+
+class CountMin:
+    "Count-min sketch: estimates never fall below the true count"
+
+    def __init__(self, width = 2048, depth = 4):
+        self.width = width
+        self.rows = [[0] * width for i in xrange(depth)]
+
+    def add(self, key, amount = 1):
+        "Count key and return its new estimate"
+        h1 = hash(key)
+        h2 = zlib.crc32(key) | 1
+        estimate = None
+        for i, row in enumerate(self.rows):
+            j = (h1 + i * h2) % self.width
+            row[j] += amount
+            if estimate is None or row[j] < estimate:
+                estimate = row[j]
+        return estimate
+
+    def decay(self, factor):
+        self.rows = [[count * factor for count in row] for row in self.rows]
+
+class HeavyHitters:
+    "The keys with the highest estimated counts, and the total counted"
+
+    def __init__(self, size = 50, width = 2048, depth = 4):
+        self.size = size
+        self.sketch = CountMin(width, depth)
+        self.top = {}
+        # Lowest count in a full top list, or lower
+        self.floor = 0
+        self.total = 0
+
+    def add(self, key, amount = 1):
+        self.total += amount
+        estimate = self.sketch.add(key, amount)
+        if key in self.top or len(self.top) < self.size:
+            self.top[key] = estimate
+        elif estimate > self.floor:
+            # Most keys stop here, without looking through the list
+            victim = min(self.top, key = self.top.get)
+            if self.top[victim] < estimate:
+                del self.top[victim]
+                self.top[key] = estimate
+            self.floor = min(self.top.values())
+
+    def decay(self, factor):
+        self.sketch.decay(factor)
+        self.top = dict([(key, count * factor) for key, count in self.top.items()])
+        self.floor *= factor
+        self.total *= factor
+
+    def report(self, name, count):
+        lines = ['%s total=%.2f' % (name, self.total)]
+        ranked = sorted(self.top.items(), key = lambda item: item[1], reverse = True)[:count]
+        for key, estimate in ranked:
+            lines.append('%s %.2f %s' % (name, estimate, key))
+        return lines
+
+class Analytics:
+    "Hot keys per kind of event, with counts halved every analytics_halflife seconds"
+
+    kinds = ['requests', 'misses', 'miss_params', 'stale', 'backend_seconds']
+
+    def __init__(self, config):
+        self.enabled = config.get('analytics', True)
+        size = int(config.get('analytics_top', 50))
+        width = int(config.get('analytics_width', 2048))
+        depth = int(config.get('analytics_depth', 4))
+        self.sketches = dict([(kind, HeavyHitters(size, width, depth)) for kind in self.kinds])
+        self.halflife = float(config.get('analytics_halflife', 600))
+        if self.enabled and self.halflife:
+            reactor.callLater(self.halflife, self.decay)
+
+    def add(self, kind, key, amount = 1):
+        if self.enabled and key:
+            self.sketches[kind].add(key, amount)
+
+    def miss(self, name):
+        "Count a miss, and the query parameters of missed pages"
+        self.add('misses', name)
+        if '?' in name:
+            for param in name.split('?', 1)[1].split('&'):
+                self.add('miss_params', param.split('=')[0])
+
+    def decay(self):
+        for sketch in self.sketches.values():
+            sketch.decay(0.5)
+        reactor.callLater(self.halflife, self.decay)
+
+    def report(self, count = 20):
+        "Plain text report, the top count keys of every kind"
+        lines = []
+        for kind in self.kinds:
+            lines.extend(self.sketches[kind].report(kind, count))
+        return '\n'.join(lines) + '\n'
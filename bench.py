@@ -0,0 +1,171 @@
+"""
+
+    File: bench.py
+    Description:
+
+        Benchmarks for the HTTP parsers and for a running Twice server.
+
+        python bench.py --parser
+            Feeds the same requests through the line and buffer parsers,
+            in-process.
+        python bench.py --target 127.0.0.1:3333 --uri / [--miss]
+            Sends requests to a server and reports throughput and latency.
+            Run it once against a server with http_parser line and once with
+            http_parser buffer.  With --miss every request carries its own
+            query string, so each one is a cache miss.
+
+"""
+
+from twisted.python import usage
+import sys, time
+
+class Options(usage.Options):
+    optFlags = [
+        ['parser', 'P', 'Benchmark the parsers in-process'],
+        ['miss', 'm', 'Make every request a cache miss'],
+    ]
+    optParameters = [
+        ['target', 't', '127.0.0.1:3333', 'Server to send requests to'],
+        ['uri', 'u', '/', 'Uri to request'],
+        ['requests', 'n', 10000, 'Number of requests', int],
+        ['concurrency', 'c', 50, 'Requests in flight at once', int],
+    ]
+
+# ---------- PARSER -----------
+
+sample_request = '\r\n'.join([
+    'GET /channel/example?tab=videos HTTP/1.1',
+    'host: www.example.com',
+    'user-agent: Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.1) Gecko/2008070208 Firefox/3.0.1',
+    'accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'accept-language: en-us,en;q=0.5',
+    'accept-encoding: gzip,deflate',
+    'accept-charset: ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+    'keep-alive: 300',
+    'connection: keep-alive',
+    'referer: http://www.example.com/',
+    'cookie: session_id=0123456789abcdef; language=en; __utma=1.2.3.4.5.6',
+    'x-real-ip: 10.0.0.1',
+    '', ''])
+
+class Transport:
+    disconnecting = False
+    def write(self, data): pass
+    def writeSequence(self, data): pass
+    def loseConnection(self): pass
+
+class Counter:
+    "Stands in for the request handler"
+
+    def __init__(self, buffered):
+        self.buffered = buffered
+        self.count = 0
+
+    def objectReceived(self, connection, request):
+        self.count += 1
+
+def parse(buffered, count, segment):
+    "Parse count requests, each arriving in pieces of segment bytes"
+    import http
+    factory = Counter(buffered)
+    pieces = [sample_request[i:i + segment] for i in xrange(0, len(sample_request), segment)]
+    started = time.time()
+    for i in xrange(count):
+        connection = http.HTTPHandler()
+        connection.factory = factory
+        connection.makeConnection(Transport())
+        for piece in pieces:
+            connection.dataReceived(piece)
+    assert factory.count == count
+    return time.time() - started
+
+def bench_parser(options):
+    for segment in [len(sample_request), 1460, 64]:
+        for name, buffered in [('line', False), ('buffer', True)]:
+            seconds = parse(buffered, options['requests'], segment)
+            print '%-6s parser, %4s byte reads: %8.0f requests/s (%.1fus each)' % (name, segment,
+                options['requests'] / seconds, seconds * 1e6 / options['requests'])
+
+# ---------- SERVER -----------
+
+class Load:
+    "Keeps a number of requests in flight until enough have been sent"
+
+    def __init__(self, options):
+        self.options = options
+        try:
+            self.host, self.port = options['target'].split(':')
+            self.port = int(self.port)
+        except ValueError:
+            self.host, self.port = options['target'], 80
+        self.sent = 0
+        self.done = 0
+        self.errors = 0
+        self.statuses = {}
+        self.latencies = []
+
+    def start(self):
+        self.started = time.time()
+        for i in xrange(min(self.options['concurrency'], self.options['requests'])):
+            self.send()
+
+    def send(self):
+        from twisted.internet import reactor
+        import http
+        request = http.HTTPObject()
+        request.uri = self.options['uri']
+        if self.options['miss']:
+            request.uri += '%sbench=%s.%s' % ('?' in request.uri and '&' or '?', self.started, self.sent)
+        request.setHeader('host', self.options['target'])
+        request.setHeader('accept-encoding', 'gzip')
+        sender = http.HTTPRequestSender(request, 30)
+        sender.noisy = False
+        sender.deferred.addCallback(self.received, time.time())
+        sender.deferred.addErrback(self.failed)
+        sender.deferred.addCallback(self.next)
+        reactor.connectTCP(self.host, self.port, sender)
+        self.sent += 1
+
+    def received(self, response, started):
+        self.latencies.append(time.time() - started)
+        self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+
+    def failed(self, reason):
+        self.errors += 1
+
+    def next(self, result):
+        from twisted.internet import reactor
+        self.done += 1
+        if self.sent < self.options['requests']:
+            self.send()
+        elif self.done == self.sent:
+            reactor.stop()
+
+    def report(self):
+        seconds = time.time() - self.started
+        latencies = sorted(self.latencies) or [0]
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        print '%s requests in %.2fs: %.0f requests/s, %s errors, statuses %s' % (self.done, seconds,
+            self.done / seconds, self.errors, self.statuses)
+        print 'latency ms: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' % (percentile(0.5), percentile(0.9),
+            percentile(0.99), latencies[-1] * 1000)
+
+def bench_server(options):
+    from twisted.internet import reactor
+    load = Load(options)
+    reactor.callWhenRunning(load.start)
+    reactor.run()
+    load.report()
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        sys.exit(1)
+    if options['parser']:
+        bench_parser(options)
+    else:
+        bench_server(options)
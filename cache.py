@@ -12,12 +12,22 @@
 
 from twisted.python import log
 from twisted.protocols.memcache import MemCacheProtocol
-from twisted.internet import protocol, reactor
-import random, time
+from twisted.internet import protocol, reactor, defer
+import sys, random, time, zlib, hashlib
+
+# Import pickling library
+try:
+    import cPickle as pickle
+except ImportError:
+    log.msg('cPickle not available, using slower pickle library.')
+    import pickle
 
 class TwiceCache:
     """ Base class for implementing a Twice Cache"""
     
+    # Bulky fields of page values, stored once per distinct content
+    shared_fields = ['chunks', 'gzip']
+    
     def __init__(self, config):
         self.config = config
         
@@ -25,7 +35,7 @@ class TwiceCache:
         "Call when the cache is online"
         pass
         
-    def set(self, dictionary, time = None):
+    def set(self, dictionary, expire_time = None):
         "Store value(s) supplied as a python dict for a certain time"
         pass
         
@@ -33,17 +43,59 @@ class TwiceCache:
         "Retreive a list of values as a python dict"
         return {}
         
+    def refresh(self, dictionary, expire_time = None):
+        "Store value(s) whose shared body is already in the cache"
+        return self.set(dictionary, expire_time)
+        
     def flush(self):
         "Delete all keys"
         pass
         
+    def evict(self, fraction = 0.25):
+        "Free some in-process memory"
+        pass
+        
+    def split(self, val):
+        "Separate the shared fields of a value, returning (digest, shared, rest)"
+        if not isinstance(val, dict) or not [True for field in self.shared_fields if field in val]:
+            return None, None, val
+        shared = tuple([val.get(field) for field in self.shared_fields])
+        digest = hashlib.sha1()
+        for pieces in shared:
+            if pieces is None:
+                digest.update('N')
+                continue
+            digest.update('L%d:' % len(pieces))
+            for piece in pieces:
+                digest.update('%d:' % len(piece))
+                digest.update(piece)
+        digest = digest.hexdigest()
+        rest = dict([(key, value) for key, value in val.items() if key not in self.shared_fields])
+        rest['shared'] = digest
+        return digest, shared, rest
+        
+    def join(self, rest, shared):
+        "Rebuild a value split by split(), keeping the digest for refresh()"
+        val = dict(rest)
+        for field, data in zip(self.shared_fields, shared):
+            if data is not None:
+                val[field] = data
+        return val
+        
 class InternalCache(TwiceCache):
     "Implements a Twice Cache using a Python dictionary"
     
     def __init__(self, config):
-        Cache.__init__(self, config)
+        TwiceCache.__init__(self, config)
         self.cache = {}
+        # Shared bodies by digest, refcounted by the keys that point at them
+        self.bodies = {}
+        if config.get('cache_compress'):
+            self.compress_after = int(config.get('cache_compress_after', 300))
+        else:
+            self.compress_after = 0
         self.ready()
+        reactor.callLater(60.0, self.sweep)
         
     def ready(self):
         limit = self.config.get('memory_limit')
@@ -52,52 +104,109 @@ class InternalCache(TwiceCache):
             self.config['memory_limit'] = 100000
         log.msg("CACHE_BACKEND: Using %s MB in-memory cache" % limit)
         
-    def set(self, dictionary, time = None):
-        for key, val in dict(dictionary.items()):
-            element = {
-                'expires_on' : time.time() + (time or 0),
+    def set(self, dictionary, expire_time = None):
+        now = time.time()
+        for key, val in dictionary.items():
+            self.delete([key])
+            digest, shared, val = self.split(val)
+            if digest:
+                body = self.bodies.get(digest)
+                if body:
+                    body['refs'] += 1
+                else:
+                    self.bodies[digest] = {
+                        'refs' : 1,
+                        'data' : shared,
+                        'compressed' : False,
+                        'used_on' : now
+                    }
+            self.cache[key] = {
+                'expires_on' : expire_time and now + expire_time,
                 'element' : val
             }
-            dictionary[key] = element
-        self.cache.update(element)
+            
+    def refresh(self, dictionary, expire_time = None):
+        now = time.time()
+        for key, val in dictionary.items():
+            element = self.cache.get(key)
+            old = element and element['element']
+            if isinstance(val, dict) and isinstance(old, dict) and 'shared' in old and val.get('shared') == old['shared']:
+                # Keep the body and its reference count as they are
+                val = dict([(k, v) for k, v in val.items() if k not in self.shared_fields])
+                self.cache[key] = {
+                    'expires_on' : expire_time and now + expire_time,
+                    'element' : val
+                }
+            else:
+                self.set({key : val}, expire_time)
             
     def get(self, keylist):
         if not isinstance(keylist, list): keylist = [keylist]
+        now = time.time()
         output = {}
         for key in keylist:
+            output[key] = None
             element = self.cache.get(key)
-            if element:
-                if time.time() > element['expires_on']:
-                    output[key] = None
-                else:
-                    output[key] = element['element']
+            if element and not (element['expires_on'] and now > element['expires_on']):
+                val = element['element']
+                if isinstance(val, dict) and 'shared' in val:
+                    val = self.join(val, self.load(val['shared'], now))
+                output[key] = val
         return output
         
+    def load(self, digest, now):
+        "Return the data of a shared body, decompressing it if it went cold"
+        body = self.bodies[digest]
+        body['used_on'] = now
+        if body['compressed']:
+            body['data'] = pickle.loads(zlib.decompress(body['data']))
+            body['compressed'] = False
+        return body['data']
+        
     def delete(self, keylist):
         for key in keylist:
-            try:
-                del self.cache[key]
-            except:
-                pass
+            element = self.cache.pop(key, None)
+            if element and isinstance(element['element'], dict) and 'shared' in element['element']:
+                digest = element['element']['shared']
+                self.bodies[digest]['refs'] -= 1
+                if self.bodies[digest]['refs'] <= 0:
+                    del self.bodies[digest]
         
     def flush(self):
         self.cache = {}
+        self.bodies = {}
+        
+    def evict(self, fraction = 0.25):
+        "Drop the keys closest to expiring and compress every remaining body"
+        keys = sorted([(element['expires_on'] or sys.maxint, key) for key, element in self.cache.items()])
+        self.delete([key for expires_on, key in keys[:int(len(keys) * fraction)]])
+        for body in self.bodies.values():
+            if not body['compressed']:
+                body['data'] = zlib.compress(pickle.dumps(body['data'], 2))
+                body['compressed'] = True
+        log.msg('CACHE_BACKEND: Evicted %s keys' % int(len(keys) * fraction))
+        
+    def sweep(self):
+        "Drop expired keys and compress bodies that have not been read lately"
+        now = time.time()
+        self.delete([key for key, element in self.cache.items() if element['expires_on'] and now > element['expires_on']])
+        if self.compress_after:
+            for body in self.bodies.values():
+                if not body['compressed'] and now - body['used_on'] > self.compress_after:
+                    body['data'] = zlib.compress(pickle.dumps(body['data'], 2))
+                    body['compressed'] = True
+        reactor.callLater(60.0, self.sweep)
         
 class MemcacheCache(TwiceCache):
     "Implements a Twice Cache using a memcache server"
 
     def __init__(self, config):
-        Cache.__init__(self, config)
+        TwiceCache.__init__(self, config)
         server = config['cache_server']
         connection_pool_size = int(config.get('cache_pool', 1))
+        self.compress = config.get('cache_compress')
         log.msg('Creating memcache connection pool to server %s...' % server)
         self.pool = []
-        # Import pickling library
-        try:
-            import cPickle as pickle
-        except ImportError:
-            log.msg('cPickle not available, using slower pickle library.')
-            import pickle
         # Parse server string
         try:
             self.host, self.port = server.split(':')
@@ -123,21 +232,54 @@ class MemcacheCache(TwiceCache):
         "Random load balancing across connection pool"
         return random.choice(self.pool)
 
-    def set(self, dictionary, time = None):
-        pickled_dict = dict([(key, pickle.dumps(val)) for key, val in dictionary.items() if val is not None])
+    def set(self, dictionary, expire_time = None):
+        pickled_dict = {}
+        bodies = {}
+        for key, val in dictionary.items():
+            if val is None: continue
+            # Variants with identical bodies share one content-addressed key
+            digest, shared, val = self.split(val)
+            if digest:
+                bodies['body_' + digest] = shared
+            pickled_dict[key] = pickle.dumps(val)
         connection = self.cache_pool()
         #log.msg('SET on cache %s' % cache)
+        self.add_bodies(connection, bodies)
         if len(pickled_dict):
-            return connection.set_multi(pickled_dict, expireTime = time)
+            return connection.set_multi(pickled_dict, expireTime = expire_time)
         else:
             return {}
 
+    def refresh(self, dictionary, expire_time = None):
+        pickled_dict = {}
+        bodies = {}
+        for key, val in dictionary.items():
+            if isinstance(val, dict) and 'shared' in val:
+                # Only the small part of the value changed; the body is only
+                # written again if it was evicted
+                pickled_dict[key] = pickle.dumps(dict([(k, v) for k, v in val.items() if k not in self.shared_fields]))
+                if [True for field in self.shared_fields if field in val]:
+                    bodies['body_' + val['shared']] = tuple([val.get(field) for field in self.shared_fields])
+            else:
+                self.set({key : val}, expire_time)
+        connection = self.cache_pool()
+        self.add_bodies(connection, bodies)
+        if len(pickled_dict):
+            return connection.set_multi(pickled_dict, expireTime = expire_time)
+            
+    def add_bodies(self, connection, bodies):
+        "Store shared bodies that aren't in memcache yet"
+        # Bodies don't expire, so one variant can't cut short the body of 
+        # another; page keys expire, and unread bodies get evicted
+        for key, shared in bodies.items():
+            connection.add(key, self.pack(shared), expireTime = 0)
+        
     def get(self, keylist):
         if not isinstance(keylist, list): keylist = [keylist]
         #log.msg('keylist: %s' % keylist)
         connection = self.cache_pool()
         #log.msg('GET on cache %s' % cache)
-        return connection.get_multi(keylist).addCallback(self._format, keylist)
+        return connection.get_multi(keylist).addCallback(self._format, keylist).addCallback(self._fetch_shared)
         
     def delete(self, keylist):
         for key in keylist:
@@ -149,6 +291,35 @@ class MemcacheCache(TwiceCache):
         #log.msg('Memcache results:\n%s' % repr(output))
         return output
         
+    def _fetch_shared(self, output):
+        "Fetch the shared bodies referenced by values in output"
+        keylist = []
+        for val in output.values():
+            if isinstance(val, dict) and 'shared' in val and 'body_' + val['shared'] not in keylist:
+                keylist.append('body_' + val['shared'])
+        if not keylist:
+            return output
+        return self.cache_pool().get_multi(keylist).addCallback(self._join_shared, output)
+        
+    def _join_shared(self, results, output):
+        for key, val in output.items():
+            if isinstance(val, dict) and 'shared' in val:
+                data = results[1].get('body_' + val['shared'])
+                # A value whose body was evicted counts as a miss
+                output[key] = data and self.join(val, self.unpack(data))
+        return output
+        
+    def pack(self, shared):
+        data = pickle.dumps(shared, 2)
+        if self.compress:
+            return 'Z' + zlib.compress(data)
+        return 'P' + data
+        
+    def unpack(self, data):
+        if data[0] == 'Z':
+            return pickle.loads(zlib.decompress(data[1:]))
+        return pickle.loads(data[1:])
+        
     def flush(self):
         self.cache_pool().flushAll()
         
\ No newline at end of file
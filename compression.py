@@ -0,0 +1,90 @@
+"""
+
+    File: compression.py
+    Description: 
+    
+        Gzip encoding of cached pages.  Literal page chunks are compressed once
+        into byte-aligned deflate segments, so a templated page can be assembled
+        into a valid gzip stream on every hit without compressing anything.
+    
+"""
+
+import zlib, struct
+
+# Gzip member header (deflate, no flags, no mtime, unix) and final empty block
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+GZIP_FINISH = '\x03\x00'
+
+# Content types worth compressing
+compressible_types = ['text/', 'application/javascript', 'application/x-javascript', 
+    'application/json', 'application/xml', 'application/xhtml+xml', 'application/rss+xml']
+
+def compressible(response):
+    "Should this response be stored with a gzip variant?"
+    if response.getHeader('content-encoding'):
+        return False
+    content_type = (response.getHeader('content-type') or '').lower()
+    return [True for t in compressible_types if content_type.startswith(t)] != []
+
+def deflate_chunk(data, level = 6):
+    "Compress data into a byte-aligned, non-final raw deflate segment"
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+def stored_chunk(data):
+    "Wrap data in uncompressed deflate blocks, which costs no compression work"
+    blocks = []
+    for i in xrange(0, len(data), 65535):
+        block = data[i:i + 65535]
+        blocks.append(struct.pack('<BHH', 0, len(block), len(block) ^ 0xffff))
+        blocks.append(block)
+    return blocks
+    
+def gzip_trailer(crc, size):
+    "Close a gzip member given the crc32 and length of the uncompressed data"
+    return GZIP_FINISH + struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+    
+def gzip_chunks(chunks, level = 6):
+    "Compress the literal (even) chunks of a split template"
+    return [i % 2 == 0 and chunk and deflate_chunk(chunk, level) or '' for i, chunk in enumerate(chunks)]
+    
+def gzip_body(data, level = 6):
+    "Compress a whole body into a single gzip member"
+    return ''.join([GZIP_HEADER, deflate_chunk(data, level), gzip_trailer(zlib.crc32(data), len(data))])
+    
+def gzip_template(chunks, compressed, render):
+    "Assemble a gzip member for a split template, rendering each tag with render()"
+    stream = GzipStream()
+    pieces = stream.header()
+    for i, chunk in enumerate(chunks):
+        if i % 2:
+            pieces.extend(stream.plain(render(chunk)))
+        elif chunk:
+            pieces.extend(stream.compressed(chunk, compressed[i]))
+    pieces.extend(stream.trailer())
+    return pieces
+    
+class GzipStream:
+    "Assembles a gzip member piece by piece, keeping track of its crc32 and length"
+    
+    def __init__(self):
+        self.crc = 0
+        self.size = 0
+        
+    def header(self):
+        return [GZIP_HEADER]
+        
+    def compressed(self, data, deflated):
+        "Add data that was compressed in advance by deflate_chunk"
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return [deflated]
+        
+    def plain(self, data):
+        "Add data without compressing it"
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return stored_chunk(data)
+        
+    def trailer(self):
+        return [gzip_trailer(self.crc, self.size)]
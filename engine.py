@@ -10,10 +10,99 @@
     
 """
 
-from twisted.internet import reactor, protocol, defer
+from twisted.internet import reactor, protocol, defer, error
 from twisted.python import log
-import traceback, urllib, time
-import cache, http
+import traceback, urllib, time, re, hashlib
+import cache, http, compression, metrics, providers, analytics
+
+class BackendError(Exception):
+    "The backend did not deliver a usable response"
+    
+    def __init__(self, message, status = 502, response = None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.response = response
+        
+class CircuitBreaker:
+    "Fails fast after repeated backend errors, letting one trial request through every reset seconds"
+    
+    def __init__(self, name, failures = 5, reset = 10.0):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.count = 0
+        self.opened_on = None
+        
+    def allow(self):
+        if self.opened_on is None:
+            return True
+        # Half open: let a single trial request through
+        if time.time() - self.opened_on >= self.reset:
+            self.opened_on = time.time()
+            return True
+        return False
+        
+    def success(self):
+        if self.opened_on is not None:
+            log.msg('CIRCUIT-CLOSED [%s]' % self.name)
+        self.count = 0
+        self.opened_on = None
+        
+    def failure(self):
+        self.count += 1
+        if self.count >= self.failures:
+            if self.opened_on is None:
+                log.msg('CIRCUIT-OPEN [%s] (%s failures)' % (self.name, self.count))
+            self.opened_on = time.time()
+
+class Limiter:
+    "Bounds outstanding backend work, queueing the rest by priority with deadlines"
+    
+    # Priorities, most urgent first
+    CLIENT = 0
+    REFRESH = 1
+    
+    def __init__(self, name, limit = 20, queue_limit = 200, queue_timeout = 5.0):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queues = [[], []]
+        
+    def depth(self):
+        return sum([len(queue) for queue in self.queues])
+        
+    def run(self, priority, func, *args):
+        "Call func (which may return a deferred) once a slot is free"
+        if self.active < self.limit:
+            return self._start(func, args)
+        if self.depth() >= self.queue_limit:
+            return defer.fail(BackendError('%s queue is full' % self.name, 503))
+        entry = [defer.Deferred(), func, args, None]
+        entry[3] = reactor.callLater(self.queue_timeout, self._expire, self.queues[priority], entry)
+        self.queues[priority].append(entry)
+        return entry[0]
+        
+    def _start(self, func, args):
+        self.active += 1
+        d = defer.maybeDeferred(func, *args)
+        d.addBoth(self._release)
+        return d
+        
+    def _release(self, result):
+        self.active -= 1
+        for queue in self.queues:
+            if queue:
+                d, func, args, call = queue.pop(0)
+                call.cancel()
+                self._start(func, args).chainDeferred(d)
+                break
+        return result
+        
+    def _expire(self, queue, entry):
+        queue.remove(entry)
+        entry[0].errback(BackendError('Timed out in %s queue' % self.name, 503))
 
 class DataStore:
     
@@ -25,9 +114,16 @@ class DataStore:
     # Status codes
     uncacheable_status = [500, 502, 503, 504, 307]
     short_status = [404, 304]
+    # Status codes that count as backend failures
+    backend_error_status = [502, 503, 504]
     
     def __init__(self, config):
         self.config = config   
+        self.metrics = metrics.Metrics()
+        self.analytics = analytics.Analytics(config)
+        
+        # Template format
+        self.template_re = re.compile(config['template_regex'])
 
         # Mecache Backend
         from twisted.protocols.memcache import MemCacheProtocol, DEFAULT_PORT
@@ -68,15 +164,49 @@ class DataStore:
         except:
             self.backend_host = self.config['backend_appserver']
             self.backend_port = 80
+        self.backend_timeout = float(config.get('backend_timeout', 30))
+        self.backend_buffered = config.get('http_parser', 'line') == 'buffer'
+        self.breaker = CircuitBreaker('%s:%s' % (self.backend_host, self.backend_port),
+            int(config.get('backend_breaker_failures', 5)), 
+            float(config.get('backend_breaker_reset', 10)))
+            
+        # Admission control
+        queue_limit = int(config.get('backend_queue_limit', 200))
+        queue_timeout = float(config.get('backend_queue_timeout', 5))
+        self.limiter = Limiter('appserver', int(config.get('backend_concurrency', 20)), queue_limit, queue_timeout)
+        self.db_limiter = Limiter('db', int(config.get('backend_db_pool_max', 1)), queue_limit, queue_timeout)
+        self.shed_queue_depth = int(config.get('shed_queue_depth', 100))
+        self.shed_loop_lag = float(config.get('shed_loop_lag', 0.5))
+        # Kept up to date by the resource monitor
+        self.loop_lag = 0.0
+        self.accept_sets = True
             
         # Cache Backend
         log.msg('Initializing cache...')
         cache_type = config['cache_type'].capitalize() + 'Cache'
         self.cache = getattr(cache, cache_type)(config)     
         
+        # Element types served by providers, by name
+        self.providers = {}
+        for path in ['providers.MemcacheProvider'] + (config.get('element_providers') or '').split(','):
+            if path.strip():
+                provider = providers.load(path.strip(), self)
+                log.msg('Element provider: %s (%s)' % (provider.name, path.strip()))
+                self.providers[provider.name] = provider
+        
         # Memorize variants of a uri
         self.uri_lookup = {}
         
+        # Fully rendered responses for anonymous visitors, keyed by page variant
+        self.rendered = {}
+        self.rendered_cookies = {}
+        self.rendered_limit = int(config.get('render_cache_size', 1000))
+        
+        # Short lived in-process copies of prefetch elements, by key
+        self.near = {}
+        self.near_ttl = float(config.get('near_cache_ttl', 10))
+        self.near_limit = int(config.get('near_cache_size', 10000))
+        
     # Init status
 
     def memcacheConnected(self, proto):
@@ -90,22 +220,109 @@ class DataStore:
     def viewdbConnected(self, viewdb):
         log.msg("Viewdb connection success.")
         self.viewdb = viewdb
+        
+    # Load
+    
+    def shrink(self):
+        "Give back memory held in-process"
+        self.rendered = {}
+        self.rendered_cookies = {}
+        self.near = {}
+        self.cache.evict()
+        
+    def overloaded(self):
+        "Should new backend work be refused?"
+        return self.limiter.depth() >= self.shed_queue_depth or self.loop_lag >= self.shed_loop_lag
 
     def get(self, keys, request):
         "Get, cache, and return elements"
-        d = defer.maybeDeferred(self.cache.get, keys)
+        if not isinstance(keys, list): keys = [keys]
+        near = self.nearGet(keys)
+        remaining = [key for key in keys if key not in near]
+        if remaining:
+            d = defer.maybeDeferred(self.cache.get, remaining)
+        else:
+            d = defer.succeed({})
         d.addCallback(self.handleMisses, request)
+        d.addCallback(self.nearSet, remaining)
+        d.addCallback(self.nearMerge, near)
         d.addErrback(self.getError)
         return d
         
+    def nearGet(self, keys):
+        "Elements from the near cache that haven't expired"
+        now = time.time()
+        output = {}
+        for key in keys:
+            entry = self.near.get(key)
+            if entry and now <= entry['expires_on']:
+                log.msg('HIT-NEAR [%s]' % key)
+                self.metrics.incr('hit_near')
+                output[key] = entry['element']
+        return output
+        
+    def nearSet(self, dictionary, keys):
+        "Keep copies of the prefetch elements that came from the cache or backend"
+        now = time.time()
+        for key in keys:
+            if self.elementType(key) not in self.prefetch_types or dictionary.get(key) is None:
+                continue
+            if key not in self.near and len(self.near) >= self.near_limit:
+                # Make room by dropping expired elements
+                for k, entry in self.near.items():
+                    if now > entry['expires_on']:
+                        del self.near[k]
+                if len(self.near) >= self.near_limit:
+                    break
+            self.near[key] = {
+                'expires_on' : now + self.near_ttl,
+                'element' : dictionary[key]
+            }
+        return dictionary
+        
+    def nearMerge(self, dictionary, near):
+        dictionary.update(near)
+        return dictionary
+        
+    def getEach(self, keys, request):
+        "Like get, but with a deferred per key that fires as soon as that element is ready"
+        deferreds = dict([(key, defer.Deferred()) for key in keys])
+        d = defer.maybeDeferred(self.cache.get, keys)
+        d.addErrback(self.cacheError, keys)
+        d.addCallback(self.handleEach, request, deferreds)
+        d.addErrback(self.eachError, deferreds)
+        return deferreds
+        
+    def handleEach(self, dictionary, request, deferreds):
+        for key, d in deferreds.items():
+            defer.maybeDeferred(self.handleMisses, {key : dictionary.get(key)}, request).chainDeferred(d)
+            
+    def eachError(self, reason, deferreds):
+        "Fail the elements that are still waiting, rather than leave them hanging"
+        for d in deferreds.values():
+            if not d.called:
+                d.errback(reason)
+            
+    def cacheError(self, reason, keys):
+        "Treat every key as a miss when the cache can't be read"
+        log.msg('ERROR: Cache lookup failed: %s' % reason.getErrorMessage())
+        return dict([(key, None) for key in keys])
+        
     def delete(self, keys):
         "Delete elements from cache"
         if not isinstance(keys, list): keys = [keys]
         self.cache.delete(keys)
+        for key in keys:
+            self.rendered.pop(key, None)
+            self.rendered.pop(key + '//gzip', None)
+            self.near.pop(key, None)
         
     def flush(self):
         "Flush entire cache"
         self.cache.flush()
+        self.rendered = {}
+        self.rendered_cookies = {}
+        self.near = {}
 
     def handleMisses(self, dictionary, request):
         "Process hits, check for validity, and fetch misses or invalids"
@@ -114,16 +331,22 @@ class DataStore:
         for key, value in dictionary.items():
             if value is None:
                 log.msg('MISS [%s]' % key)
-                d = getattr(self, 'fetch_' + self.elementType(key))(request, self.elementId(key))
+                self.metrics.incr('miss_' + self.elementType(key))
+                self.analytics.miss(self.describe(request, key))
+                d = self.elementFetch(request, key)
+                d.addBoth(self.fetchTimed, request, self.elementType(key), time.time())
                 missing_deferreds.append(d)
                 missing_elements.append(key)
-            elif not getattr(self, 'valid_' + self.elementType(key))(request, self.elementId(key), value):
+            elif not self.elementValid(request, key, value):
                 log.msg('INVALID [%s]' % key)
-                d = getattr(self, 'fetch_' + self.elementType(key))(request, self.elementId(key))
+                self.metrics.incr('invalid_' + self.elementType(key))
+                d = self.elementFetch(request, key, stale = value)
+                d.addBoth(self.fetchTimed, request, self.elementType(key), time.time())
                 missing_deferreds.append(d)
                 missing_elements.append(key)
             else:
                 log.msg('HIT [%s]' % key)
+                self.metrics.incr('hit_' + self.elementType(key))
         # Wait for all items to be fetched
         if missing_deferreds:
             deferredList = defer.DeferredList(missing_deferreds)
@@ -132,6 +355,12 @@ class DataStore:
         else:
             return defer.succeed(dictionary)
         
+    def fetchTimed(self, result, request, element_type, started):
+        seconds = time.time() - started
+        request.addTiming('fetch_' + element_type, seconds)
+        self.metrics.timing('fetch_' + element_type, seconds)
+        return result
+        
     def returnElements(self, results, dictionary, missing_elements):
         if not isinstance(results, list): results = [results]
         uncached_elements = dict([(key, results.pop(0)[1]) for key in missing_elements])
@@ -146,19 +375,66 @@ class DataStore:
             
     def elementHash(self, request, element_type, element_id = None):
         "Hash function for elements"
+        provider = self.providers.get(element_type.lower())
+        if provider:
+            return provider.hash(request, element_id)
         return getattr(self, 'hash_' + element_type.lower())(request, element_id)
         
+    def elementValid(self, request, key, value):
+        provider = self.providers.get(self.elementType(key))
+        if provider:
+            return provider.valid(request, self.elementId(key), value)
+        return getattr(self, 'valid_' + self.elementType(key))(request, self.elementId(key), value)
+        
+    def elementFetch(self, request, key, stale = None):
+        "Deferred element; provider elements are batched with the other misses of their type"
+        provider = self.providers.get(self.elementType(key))
+        if provider:
+            return provider.get(request, self.elementId(key), stale)
+        return getattr(self, 'fetch_' + self.elementType(key))(request, self.elementId(key), stale = stale)
+        
+    def elementAnonymous(self, element_type):
+        "Is the element rendered for visitors without a session?"
+        provider = self.providers.get(element_type)
+        return provider is not None and provider.anonymous
+        
     def elementType(self, key):
         return key.split('_')[0]
         
+    def elementRequest(self, request, key):
+        "The request a page or fragment element is fetched with"
+        if self.elementType(key) == 'fragment':
+            return request.fragments.get(key, request)
+        return request
+        
+    def describe(self, request, key = None):
+        "Readable name of a page (host and uri), or of another element (its key)"
+        if key and self.elementType(key) not in ['page', 'fragment']:
+            return key
+        if key:
+            request = self.elementRequest(request, key)
+        return (request.getHeader('x-real-host') or request.getHeader('host') or '') + self.normalize_uri(request.uri)
+        
     def elementId(self, key):
         return '_'.join(key.split('_')[1:])
         
     # Page
     
+    # Bump to abandon page keys made by an older scheme
+    page_key_version = 2
+    
     def hash_page(self, request, id=None, cookies = []):
-        # Hash the request key
-        key = 'page_' + (request.getHeader('x-real-host') or request.getHeader('host')) + request.uri
+        # Readable prefix, fixed length digest of everything that makes the variant
+        if request.fragment:
+            prefix = 'fragment'
+        else:
+            prefix = 'page'
+        variant = self.page_variant(request, cookies)
+        return '%s_v%s_%s' % (prefix, self.page_key_version, hashlib.sha1(variant).hexdigest())
+        
+    def page_variant(self, request, cookies = []):
+        "Describe the variant of a page that a request asks for"
+        key = (request.getHeader('x-real-host') or request.getHeader('host')) + self.normalize_uri(request.uri)
         # Internationalization salt
         if self.config.get('hash_lang_header'):
             header = request.getHeader('accept-language') or self.config.get('hash_lang_default', 'en-us')
@@ -179,16 +455,70 @@ class DataStore:
             if found_cookies:
                 key += '//' + ','.join(found_cookies)
         return key
+        
+    def normalize_uri(self, uri):
+        "Order query parameters by name, so that equivalent urls share an entry"
+        if '?' not in uri:
+            return uri
+        path, query = uri.split('?', 1)
+        params = [param for param in query.split('&') if param]
+        # Stable, so repeated parameters keep their order
+        params.sort(key = lambda param: param.split('=')[0])
+        return path + '?' + '&'.join(params)
     
-    def fetch_page(self, request, id):
+    def fetch_page(self, request, id, refresh = False, stale = None):
+        # Fail fast while the backend is unhealthy or we are overloaded
+        if not self.breaker.allow():
+            log.msg('CIRCUIT-OPEN [%s]' % id)
+            d = defer.fail(BackendError('Circuit open for %s' % self.breaker.name, 503))
+            return d.addErrback(self.page_failed, request, id)
+        if self.overloaded():
+            log.msg('SHED [%s] (queue depth %s, loop lag %.3fs)' % (id, self.limiter.depth(), self.loop_lag))
+            d = defer.fail(BackendError('Shedding load', 503))
+            return d.addErrback(self.page_failed, request, id)
+        if refresh:
+            priority = Limiter.REFRESH
+        else:
+            priority = Limiter.CLIENT
+        d = self.limiter.run(priority, self.send_page, request, stale)
+        d.addCallbacks(self.page_received, self.page_error)
+        d.addCallback(self.extract_page, request, stale)
+        d.addErrback(self.page_failed, request, id)
+        return d
+        
+    def send_page(self, request, stale = None):
+        # Leave the client's request alone, it is still needed to render the page
+        request = request.copy()
         # Tell backend that we are Twice and strip cache-control headers
         request.setHeader(self.config.get('twice_header'), 'true')
         request.removeHeader('cache-control')
+        # Twice does its own compression, so ask for plain bodies
+        request.removeHeader('accept-encoding')
+        # Only ask for a 304 if we hold the page it would refer to
+        request.removeHeader('if-none-match')
+        request.removeHeader('if-modified-since')
+        # Fetch the whole page, so that it can be cached and sliced here
+        request.removeHeader('range')
+        request.removeHeader('if-range')
+        if request.method.upper() == 'HEAD':
+            request.method = 'GET'
+        if stale and stale.get('validators'):
+            etag, last_modified = stale['validators']
+            if etag:
+                request.setHeader('if-none-match', etag)
+            if last_modified:
+                request.setHeader('if-modified-since', last_modified)
         # Make the request
-        sender = http.HTTPRequestSender(request)
+        sender = http.HTTPRequestSender(request, self.backend_timeout)
         sender.noisy = False
-        reactor.connectTCP(self.backend_host, self.backend_port, sender)
-        return sender.deferred.addCallback(self.extract_page, request).addErrback(self.page_failed, request)
+        sender.buffered = self.backend_buffered
+        reactor.connectTCP(self.backend_host, self.backend_port, sender, timeout = self.backend_timeout)
+        sender.deferred.addBoth(self.backendTimed, request, time.time())
+        return sender.deferred
+        
+    def backendTimed(self, result, request, started):
+        self.analytics.add('backend_seconds', self.describe(request), time.time() - started)
+        return result
         
     def valid_page(self, request, id, value):
         "Determine whether the page can be served stale"
@@ -196,35 +526,96 @@ class DataStore:
         # Force refetch of very stale (3x cache_control value) pages
         if now > value['expires_on'] + value['cache_control'] * 3:
             log.msg('STALE-HARD [%s]' % id)
+            self.analytics.add('stale', self.describe(request))
             return False
         # Sever semi-stale pages but refresh in the background
         elif now > value['expires_on']:
             log.msg('STALE-SOFT [%s]' % id)
-            self.fetch_page(request, id)
+            self.analytics.add('stale', self.describe(request))
+            self.fetch_page(request, id, refresh = True, stale = value)
             return True
         # Valid page
         else:
             return True
         
-    def page_failed(self, response, request):
-        log.msg('ERROR: Could not retrieve [%s]' % request.uri)
-        response.printBriefTraceback()
-        # TODO: Return something meaningful!
-        return ''
+    def page_received(self, response):
+        "Track backend health"
+        if response.status in self.backend_error_status:
+            self.breaker.failure()
+            raise BackendError('Backend returned %s' % response.status, response.status, response)
+        self.breaker.success()
+        return response
+        
+    def page_error(self, reason):
+        # Queueing and shedding errors say nothing about the backend's health
+        if not reason.check(BackendError):
+            self.breaker.failure()
+        return reason
+        
+    def page_failed(self, reason, request, id):
+        "Fall back to the last cached version of a page the backend could not deliver"
+        log.msg('ERROR: Could not retrieve [%s]: %s' % (request.uri, reason.getErrorMessage()))
+        key = self.elementType(self.hash_page(request)) + '_' + id
+        d = defer.maybeDeferred(self.cache.get, key)
+        d.addErrback(self.getError)
+        d.addCallback(self.page_fallback, reason, request, key)
+        return d
+        
+    def page_fallback(self, cached, reason, request, key):
+        value = cached and cached.get(key)
+        if value:
+            # Serve it even if it is hard-stale, but say so
+            log.msg('SERVE-STALE [%s]' % key)
+            value = dict(value)
+            for head in ['head', 'gzip_head']:
+                if head in value:
+                    value[head] += 'warning: 111 Twice "Revalidation Failed"\r\n'
+            return value
+        if reason.check(BackendError) and reason.value.response:
+            return self.extract_page(reason.value.response, request)
+        elif reason.check(BackendError):
+            return self.error_page(reason.value.status)
+        elif reason.check(error.TimeoutError):
+            return self.error_page(504)
+        else:
+            reason.printBriefTraceback()
+            return self.error_page(502)
+            
+    def error_page(self, status):
+        "Uncached page value for a response Twice generates itself"
+        response = http.HTTPObject()
+        response.status = status
+        response.body = http.messages.get(status, 'ERROR')
+        value = {
+            'dependencies' : [],
+            'cookies' : [''],
+            'response' : response,
+            'expires_on' : time.time(),
+            'cache_control' : 0
+        }
+        return self.prepare_page(value)
         
-    def extract_page(self, response, request):
+    def extract_page(self, response, request, stale = None):
 
-        # Extract uniqueness info
-        cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
+        # The backend confirmed that our copy is still current
+        if response.status == 304 and stale:
+            return self.revalidate_page(response, request, stale)
+
+        # Extract uniqueness info (fragments don't vary by cookie)
+        if request.fragment:
+            cookies = ['']
+        else:
+            cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
         key = self.hash_page(request, cookies = cookies)
 
         # Store uri variant
-        if key not in self.uri_lookup.setdefault(request.uri, []):
-            log.msg('Added new varient for %s: %s' % (request.uri, key))
-            self.uri_lookup[request.uri].append(key)
+        uri = self.normalize_uri(request.uri)
+        if key not in self.uri_lookup.setdefault(uri, []):
+            log.msg('Added new varient for %s: %s (%s)' % (uri, key, self.page_variant(request, cookies)))
+            self.uri_lookup[uri].append(key)
 
-        # Override for non GET's
-        if request.method.upper() not in ['GET']:
+        # Override for non GET's (HEADs were sent to the backend as GETs)
+        if request.method.upper() not in ['GET', 'HEAD']:
             log.msg('NO-CACHE (Method is %s) [%s]' % (request.method, key))
             cache = False
             cache_control = 0
@@ -248,32 +639,146 @@ class DataStore:
         # Actual return value  
         value =  {
             'dependencies' : [],
+            'cookies' : cookies,
             'response' : response,
             'expires_on' : time.time() + cache_control,
             'cache_control' : cache_control
         }
         if cache:
             response.cookies = []
+        self.prepare_page(value, cacheable = cache)
+        if cache and self.accept_sets:
             self.cache.set({key : value}, cache_control + 86400) # Keep pages for up to 24 hours
         return value
         
-    # Memcache
+    def revalidate_page(self, response, request, stale):
+        "Extend the life of a cached page without storing its body again"
+        key = self.hash_page(request, cookies = stale['cookies'])
+        cache_control = response.getCacheControlHeader(self.config.get('cache_header')) or stale['cache_control']
+        log.msg('REVALIDATED [%s] (for %ss)' % (key, cache_control))
+        value = dict(stale)
+        value['expires_on'] = time.time() + cache_control
+        value['cache_control'] = cache_control
+        if self.accept_sets:
+            self.cache.refresh({key : value}, cache_control + 86400)
+        return value
+        
+    def prepare_page(self, value, cacheable = False):
+        "Split the body into template chunks and prebuild the response head"
+        response = value['response']
+        # Literal text at even indices, tag expressions at odd indices
+        chunks = value['chunks'] = self.template_re.split(response.body)
+        # Validators from the backend, used to revalidate the page upstream
+        value['validators'] = (response.getHeader('etag'), response.getHeader('last-modified'))
+        if len(chunks) > 1:
+            # Rendered output differs from what the backend's validators describe
+            response.removeHeader('etag')
+            response.removeHeader('last-modified')
+        elif cacheable:
+            if not response.getHeader('etag'):
+                response.setHeader('etag', '"%s"' % hashlib.sha1(chunks[0]).hexdigest())
+            if response.status == 200:
+                response.setHeader('accept-ranges', 'bytes')
+        value['etag'] = response.getHeader('etag')
+        value['last_modified'] = response.getHeader('last-modified')
+        # Compress once here so that hits never pay for it
+        if cacheable and self.config.get('gzip') and compression.compressible(response) \
+                and len(response.body) >= int(self.config.get('gzip_min_length', 256)):
+            level = int(self.config.get('gzip_level', 6))
+            if len(chunks) == 1:
+                value['gzip'] = [compression.gzip_body(chunks[0], level)]
+            else:
+                value['gzip'] = compression.gzip_chunks(chunks, level)
+            vary = response.getHeader('vary')
+            response.setHeader('vary', vary and vary + ', Accept-Encoding' or 'Accept-Encoding')
+        response.body = ''
+        # Overwrite headers
+        response.setHeader('connection', 'close')
+        response.setHeader('via', 'Twice 0.1')
+        # Delete twice/cache headers
+        response.removeHeader(self.config.get('cache_header'))
+        response.removeHeader(self.config.get('twice_header'))
+        response.removeHeader(self.config.get('cookies_header'))
+        value['head'] = response.writeHead(exclude = ['content-length'])
+        if 'gzip' in value:
+            # The compressed variant needs its own entity tag
+            if value['etag']:
+                value['gzip_etag'] = value['etag'].endswith('"') and value['etag'][:-1] + '-gz"' or value['etag'] + '-gz'
+                response.setHeader('etag', value['gzip_etag'])
+            response.setHeader('content-encoding', 'gzip')
+            value['gzip_head'] = response.writeHead(exclude = ['content-length'])
+            response.removeHeader('content-encoding')
+            if value['etag']:
+                response.setHeader('etag', value['etag'])
+        return value
+        
+    # Rendered responses
     
-    def hash_memcache(self, request, id):
-        return 'memcache_' + id
+    def get_rendered(self, request):
+        "Return the serialized response pieces for a request, if a fresh one was rendered"
+        cookies = self.rendered_cookies.get(self.hash_page(request))
+        if cookies is None:
+            return None
+        key = self.hash_page(request, cookies = cookies)
+        # Clients that accept gzip only get the response built for one of them
+        if request.gzip:
+            key += '//gzip'
+        entry = self.rendered.get(key)
+        if entry and time.time() <= entry['expires_on']:
+            log.msg('HIT-RENDERED [%s]' % key)
+            return entry['data']
+        return None
+        
+    def set_rendered(self, request, value, data, gzip = False):
+        "Remember the serialized response for a render-invariant page"
+        if not self.config.get('render_cache') or not self.accept_sets or value.get('cookies') is None:
+            return
+        key = self.hash_page(request, cookies = value['cookies'])
+        if gzip:
+            key += '//gzip'
+        if key not in self.rendered and len(self.rendered) >= self.rendered_limit:
+            # Make room by dropping expired responses
+            now = time.time()
+            for k, entry in self.rendered.items():
+                if now > entry['expires_on']:
+                    del self.rendered[k]
+                    self.rendered_cookies.pop(entry['base'], None)
+            if len(self.rendered) >= self.rendered_limit:
+                return
+        base = self.hash_page(request)
+        self.rendered_cookies[base] = value['cookies']
+        self.rendered[key] = {
+            'base' : base,
+            'expires_on' : value['expires_on'],
+            'data' : data
+        }
+        
+    # Fragment
     
-    def fetch_memcache(self, request, id):
-        log.msg('Looking up memcache %s' % id)
-        return self.proto.get(id).addCallback(self.extract_memcache, request, id)  
+    def hash_fragment(self, request, id):
+        "Fragments are cached like pages, requested with the headers of the page including them"
+        fragment = request.copy()
+        fragment.method = 'GET'
+        fragment.uri = id
+        fragment.body = ''
+        fragment.removeHeader('content-length')
+        fragment.fragment = True
+        fragment.fragments = {}
+        # Fragments are shared by every visitor, so don't tell the backend who is asking
+        fragment.cookies = []
+        fragment.removeHeader('authorization')
+        key = self.hash_page(fragment)
+        request.fragments[key] = fragment
+        return key
         
-    def extract_memcache(self, result, request, id):
-        value = result and result[1]
-        self.cache.set({self.hash_memcache(request, id) : value}, 30) # 30 seconds
-        return value
+    def fetch_fragment(self, request, id, stale = None):
+        return self.fetch_page(request.fragments['fragment_' + id], id, stale = stale)
         
-    def valid_memcache(self, request, id, value):
-        return True
-                
+    def valid_fragment(self, request, id, value):
+        return self.valid_page(request.fragments['fragment_' + id], id, value)
+        
+    # Memcache (elements come from providers.MemcacheProvider)
+    
     def incr_memcache(self, key):
         log.msg('Incrementing memcache %s' % key)
         return self.proto.increment(key)
@@ -291,16 +796,22 @@ class DataStore:
         else:
             return ''
       
-    def fetch_session(self, request, id):
+    def fetch_session(self, request, id, stale = None):
         id = self._read_session(request)
-        return self.db.runInteraction(self._session, id).addCallback(self.extract_session, request, id)
+        d = self.db_limiter.run(Limiter.CLIENT, self.db.runInteraction, self._session, id)
+        return d.addCallback(self.extract_session, request, id).addErrback(self.session_failed, request, id)
+        
+    def session_failed(self, reason, request, id):
+        log.msg('ERROR: Could not look up session %s: %s' % (id, reason.getErrorMessage()))
+        return None
     
     def extract_session(self, result, request, id):
         if len(result[0]):
             output = result[0][0]
         else:
             output = {}
-        self.cache.set({self.hash_session(request, id) : output}, 86400) # 24 hours
+        if self.accept_sets:
+            self.cache.set({self.hash_session(request, id) : output}, 86400) # 24 hours
         return output
     
     def valid_session(self, request, id, value):
@@ -12,8 +12,8 @@
 
 from twisted.internet import reactor, defer
 from twisted.python import log
-import sys, urllib, time, re, traceback
-import parser, engine, http, cache
+import sys, os, urllib, urlparse, time, traceback, random
+import parser, engine, http, cache, compression, purge
 
 class RequestHandler(http.HTTPRequestDispatcher):
     
@@ -21,16 +21,32 @@ class RequestHandler(http.HTTPRequestDispatcher):
 
         # Caches and config
         self.config = config
-        
-        # Template format
-        self.specialization_re = re.compile(self.config['template_regex'])
+        self.buffered = config.get('http_parser', 'line') == 'buffer'
         
         # Data Store
         log.msg('Initializing data store...')
         self.store = storage.DataStore(config)
+        
+        # Admin interface
+        self.admin_path = self.config.get('admin_path', '/twice/')
+        self.admin_clients = (self.config.get('admin_clients') or '127.0.0.1').split(',')
+        self.profiler = None
+        self.profile_max_seconds = float(self.config.get('profile_max_seconds', 300))
+        self.including = False
+        
+        # Ranges a request may ask for before it gets the whole page instead
+        self.max_ranges = int(config.get('max_ranges', 20))
+        
+        # Other Twice nodes to forward purges to
+        self.peers = purge.PurgeFanout(config, self.store.metrics)
                             
     def objectReceived(self, connection, request):
         "Main request handler"
+        request.mark('parse')
+        # Handle admin requests
+        if request.uri.startswith(self.admin_path):
+            self.admin(connection, request)
+            return
         # Handle mark dirty requests
         if request.getHeader(self.config.get('purge_header')) is not None:
             self.markDirty(connection, request)
@@ -45,15 +61,35 @@ class RequestHandler(http.HTTPRequestDispatcher):
             real_host = self.config.get('rewrite_host', request.getHeader('x-real-host'))
             if real_host:
                 request.setHeader('host', real_host)
+            # Remember the encoding before the request is forwarded upstream
+            request.gzip = request.acceptsEncoding('gzip')
+            self.store.analytics.add('requests', self.store.describe(request))
+            
+            # Serve prebuilt responses to anonymous visitors
+            session_key = self.store.elementHash(request, 'session')
+            conditional = request.getHeader('if-none-match') or request.getHeader('if-modified-since') or request.getHeader('range')
+            if not session_key and request.method.upper() in ['GET', 'HEAD'] and not conditional:
+                data = self.store.get_rendered(request)
+                if data:
+                    request.mark('prefetch')
+                    if request.method.upper() == 'HEAD':
+                        data = data[:2]
+                    header = self.timingHeader(connection, request)
+                    if header:
+                        data = [data[0] + header] + data[1:]
+                    connection.transport.writeSequence(data)
+                    connection.shutdown()
+                    self.finishRequest(request, 'prebuilt')
+                    log.msg('RENDER [%s] (%.3fs after request received, prebuilt)' % (request.uri, (time.time() - request.received_on)))
+                    return
             
             # Add in prefetch keys
             keys = [self.store.elementHash(request, 'page')]
-            session_key = self.store.elementHash(request, 'session')
             if session_key:
                 keys.append(session_key)
 
             # Retrieve keys
-            log.msg('PREFETCH: %s' % keys)
+            log.msg('PREFETCH: %s (%s)' % (keys, self.store.page_variant(request)))
             self.store.get(keys, request).addCallback(self.checkPage, connection, request)
                         
 # ---------- CACHE EXPIRATION -----------
@@ -66,6 +102,21 @@ class RequestHandler(http.HTTPRequestDispatcher):
         except:
             log.msg('Could not read expiration type: %s' % repr(request.getHeader(self.config.get('purge_header'))))
             return
+        # Batches come from peers, which have already told the rest of the fleet
+        if kind == 'batch':
+            purges = [line.split(' ', 1) for line in request.body.splitlines() if ' ' in line]
+            for kind, uri in purges:
+                self.expire(kind, uri)
+            connection.sendCode(200, "Expired %s keys" % len(purges))
+            return True
+        self.expire(kind, uri)
+        self.peers.enqueue(kind, uri)
+        # Write response
+        connection.sendCode(200, "Expired %s_%s" % (kind, uri))
+        return True
+        
+    def expire(self, kind, uri):
+        "Delete the keys named by a purge from this node"
         log.msg("Expire type: %s, arg: %s" % (kind, uri))
         # Parse request
         if kind == '*':
@@ -73,9 +124,9 @@ class RequestHandler(http.HTTPRequestDispatcher):
             log.msg('Cleared entire cache')
         elif kind == 'url':
             try:
-                keys = self.store.uri_lookup[uri]
+                keys = self.store.uri_lookup[self.store.normalize_uri(uri)]
                 self.store.delete(keys)
-                del self.store.uri_lookup[uri]
+                del self.store.uri_lookup[self.store.normalize_uri(uri)]
                 log.msg('Deleted all variants of %s' % uri)
             except:
                 pass
@@ -94,17 +145,15 @@ class RequestHandler(http.HTTPRequestDispatcher):
                 log.msg('Deleted %s_%s' % (kind, uri[1:]))
             except:
                 pass
-        # Write response
-        connection.sendCode(200, "Expired %s_%s" % (kind, uri))
-        return True       
                 
 # ---------- CLIENT RESPONSE -----------  
 
     def checkPage(self, elements, connection, request, extra = {}):
         "See if we have the correct version of the page"        
+        request.mark('prefetch')
         # Process cookies
-        response = [val for key, val in elements.items() if key.startswith('page_')][0]['response']
-        cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
+        page = [val for key, val in elements.items() if key.startswith('page_')][0]
+        cookies = page.get('cookies') or sorted((page['response'].getHeader(self.config.get('cookies_header')) or '').split(','))
         key = self.store.hash_page(request, cookies = cookies)
             
         # If the page we fetched doesn't have the right cookies, try again!
@@ -115,35 +164,77 @@ class RequestHandler(http.HTTPRequestDispatcher):
 
     def scanPage(self, elements, connection, request, extra = {}):
         "Scan for missing elements"
+        request.mark('variant')
         elements.update(extra)
         logged_in = [True for key, value in elements.items() if key.startswith('session_') and value is not None]
-        data = [val for key, val in elements.items() if key.startswith('page_')][0]['response'].body
-        matches = self.specialization_re.findall(data)
+        page = [val for key, val in elements.items() if key.startswith('page_')][0]
+        if 'chunks' not in page:
+            self.store.prepare_page(page)
+        # Element needed by each tag, by chunk index
+        tag_keys = self.scanTags(page['chunks'], request, logged_in)
         missing_keys = []
-        for match in matches:
+        for i in sorted(tag_keys.keys()):
+            if tag_keys[i] and tag_keys[i] not in missing_keys:
+                missing_keys.append(tag_keys[i])
+        if missing_keys and self.config.get('stream') and request.method.upper() != 'HEAD':
+            deferreds = self.store.getEach(missing_keys, request)
+            for key, d in deferreds.items():
+                if key.startswith('fragment_'):
+                    d.addCallback(self.scanFragments, request, elements, logged_in)
+            self.streamPage(connection, request, elements, tag_keys, deferreds)
+        elif missing_keys:
+            d = self.store.get(missing_keys, request)
+            d.addCallback(self.scanFragments, request, elements, logged_in)
+            d.addCallback(self.renderPage, connection, request, elements)
+        else:
+            self.renderPage({}, connection, request, elements)
+
+    def scanTags(self, chunks, request, logged_in, includes = True):
+        "Keys of the elements needed by the tags in chunks, by chunk index"
+        tag_keys = {}
+        for i in xrange(1, len(chunks), 2):
             # Parse element
             try:
-                parts = match.strip().split()
+                parts = chunks[i].strip().split()
                 command = parts[0].lower()
                 element_type = parts[1].lower()
                 element_id = parts[2]
             except:
                 traceback.print_exc()
                 continue
-            if element_type not in ['page', 'session']:
-                if element_type in ['memcache', 'viewdb'] or logged_in:
-                    key = self.store.elementHash(request, element_type, element_id)
-                    if key and key not in missing_keys:
-                        missing_keys.append(key)
-        if missing_keys:
-            d = self.store.get(missing_keys, request)
-            d.addCallback(self.renderPage, connection, request, elements)
-        else:
-            self.renderPage({}, connection, request, elements)
+            if command == 'include' and element_type == 'page':
+                # Included pages are cached and fetched on their own
+                if includes:
+                    tag_keys[i] = self.store.elementHash(request, 'fragment', element_id)
+            elif element_type not in ['page', 'session']:
+                if self.store.elementAnonymous(element_type) or logged_in:
+                    tag_keys[i] = self.store.elementHash(request, element_type, element_id)
+        return tag_keys
+        
+    def scanFragments(self, result, request, elements, logged_in):
+        "Fetch the elements needed by the tags of the fragments in result"
+        missing_keys = []
+        for key, fragment in (result or {}).items():
+            if not key.startswith('fragment_') or not fragment or fragment['response'].status != 200:
+                continue
+            if 'chunks' not in fragment:
+                self.store.prepare_page(fragment)
+            # Fragments can't include other fragments
+            for tag_key in self.scanTags(fragment['chunks'], request, logged_in, includes = False).values():
+                if tag_key and tag_key not in elements and tag_key not in result and tag_key not in missing_keys:
+                    missing_keys.append(tag_key)
+        if not missing_keys:
+            return result
+        d = self.store.get(missing_keys, request)
+        d.addCallback(self.mergeElements, result)
+        return d
+        
+    def mergeElements(self, new_elements, elements):
+        elements.update(new_elements or {})
+        return elements
 
-    def renderPage(self, new_elements, connection, request, elements):
-        "Write the page out to the request's connection"
-        elements.update(new_elements)
+    def loadElements(self, elements, request):
+        "Make a request's elements available to the templating functions"
         for etype in ['page', 'session', 'favorite', 'subscription']:
             eitems = [val for key, val in elements.items() if key.startswith(etype)]
             if eitems:
@@ -153,41 +244,328 @@ class RequestHandler(http.HTTPRequestDispatcher):
             setattr(self, 'current_' + etype, eitems)
             #log.msg('Current %s: %s' % (etype, eitems))
 
-        for etype in ['memcache', 'viewdb']:
+        for etype in self.store.providers.keys():
             #log.msg('elements: %s' % elements.items())
-            eitems = dict([(self.store.elementId(key), val) for key, val in elements.items() if key.startswith(etype)])
+            eitems = dict([(self.store.elementId(key), val) for key, val in elements.items() if key.startswith(etype + '_')])
             setattr(self, 'current_' + etype, eitems)
             #log.msg('Current %s: %s' % (etype, eitems))
+            
+        self.current_fragment = dict([(fragment.uri, elements.get(key)) for key, fragment in request.fragments.items()])
+        
+    def unloadElements(self):
+        for etype in ['session', 'favorite', 'subscription', 'fragment']:
+            setattr(self, 'current_' + etype, {})
 
+    def renderPage(self, new_elements, connection, request, elements):
+        "Write the page out to the request's connection"
+        request.mark('elements')
+        elements.update(new_elements)
+        self.loadElements(elements, request)
         response = self.current_page['response']
-        # Do Templating
-        data = self.specialization_re.sub(self.specialize, response.body)
+        chunks = self.current_page['chunks']
+        gzip = request.gzip and self.current_page.get('gzip')
+        # Answer from the client's own copy when it is current
+        if self.notModified(request, self.current_page, gzip):
+            head = self.current_page[gzip and 'gzip_head' or 'head'] + self.timingHeader(connection, request)
+            status = '%s 304 %s\r\n' % (response.protocol, http.messages[304])
+            connection.transport.writeSequence([status, head[head.index('\r\n') + 2:], '\r\n'])
+            connection.shutdown()
+            self.finishRequest(request, 'not_modified')
+            log.msg('NOT-MODIFIED [%s] (%.3fs after request received)' % (request.uri, (time.time() - request.received_on)))
+            return
+        # Slices of cached pages that render the same for everyone
+        if len(chunks) == 1 and response.status == 200 and self.current_page['cache_control'] > 0 \
+                and request.method.upper() in ['GET', 'HEAD'] and request.getHeader('range') \
+                and self.rangeCurrent(request, self.current_page):
+            ranges = http.parseRange(request.getHeader('range'), len(chunks[0]))
+            if ranges is not None and len(ranges) <= self.max_ranges:
+                self.unloadElements()
+                self.sendRanges(connection, request, self.current_page, ranges)
+                return
+        # Do Templating, reusing the cached literal chunks as they are
+        if gzip and len(chunks) == 1:
+            pieces = gzip
+        elif gzip:
+            pieces = compression.gzip_template(chunks, gzip, self.specialize)
+        else:
+            pieces = []
+            for i, chunk in enumerate(chunks):
+                if i % 2:
+                    chunk = self.specialize(chunk)
+                if chunk:
+                    pieces.append(chunk)
         # Remove current stuff
-        for etype in ['session', 'favorite', 'subscription']:
-            setattr(self, 'current_' + etype, {})
-        # Overwrite headers
-        response.setHeader('connection', 'close')
-        response.setHeader('content-length', len(data))
-        response.setHeader('via', 'Twice 0.1')
-        # Delete twice/cache headers
-        response.removeHeader(self.config.get('cache_header'))
-        response.removeHeader(self.config.get('twice_header'))
-        response.removeHeader(self.config.get('cookies_header'))
+        self.unloadElements()
+        request.mark('render')
         # Write response
-        connection.transport.write(response.writeResponse(body = data))
+        if gzip:
+            head = self.current_page['gzip_head']
+        else:
+            head = self.current_page['head']
+        output = response.writeResponseSequence(pieces, head)
+        # Answer HEADs with the head the GET would have had
+        if request.method.upper() == 'HEAD':
+            sent = output[:2]
+        else:
+            sent = output
+        header = self.timingHeader(connection, request)
+        if header:
+            connection.transport.writeSequence([sent[0] + header] + sent[1:])
+        else:
+            connection.transport.writeSequence(sent)
         connection.shutdown()
+        # Pages without tags render the same for every anonymous visitor
+        anonymous = not self.store.elementHash(request, 'session')
+        if len(chunks) == 1 and anonymous and request.method.upper() == 'GET' and self.current_page['cache_control'] > 0:
+            self.store.set_rendered(request, self.current_page, output, gzip = bool(request.gzip))
+        self.finishRequest(request, 'rendered')
         log.msg('RENDER [%s] (%.3fs after request received)' % (request.uri, (time.time() - request.received_on)))
 
+    def streamPage(self, connection, request, elements, tag_keys, deferreds):
+        "Send the head and everything up to the first missing element, then the rest as elements arrive"
+        # deferreds only holds the elements that haven't arrived yet
+        for key, d in deferreds.items():
+            d.addCallback(self.elementArrived, elements, deferreds, key)
+            d.addErrback(self.elementFailed, deferreds, key)
+        page = [val for key, val in elements.items() if key.startswith('page_')][0]
+        response = page['response']
+        gzip = request.gzip and page.get('gzip')
+        # The length isn't known up front
+        chunked = request.protocol.upper() == 'HTTP/1.1' and response.protocol.upper() == 'HTTP/1.1'
+        head = page[gzip and 'gzip_head' or 'head'] + self.timingHeader(connection, request)
+        if chunked:
+            head += 'transfer-encoding: chunked\r\n'
+        connection.transport.writeSequence([head, '\r\n'])
+        stream = gzip and compression.GzipStream()
+        d = defer.maybeDeferred(self.streamChunks, None, connection, request, elements, tag_keys, deferreds, 0, stream, chunked)
+        d.addErrback(self.streamFailed, connection, request, chunked)
+        
+    def elementArrived(self, result, elements, deferreds, key):
+        elements.update(result)
+        deferreds.pop(key, None)
+        return result
+        
+    def elementFailed(self, reason, deferreds, key):
+        "Render the page without an element that couldn't be fetched"
+        log.msg('ERROR: Could not fetch [%s]: %s' % (key, reason.getErrorMessage()))
+        deferreds.pop(key, None)
+        return {}
+        
+    def streamChunks(self, result, connection, request, elements, tag_keys, deferreds, start, stream, chunked):
+        "Write chunks from start on, stopping at a tag whose element hasn't arrived yet"
+        self.loadElements(elements, request)
+        chunks = self.current_page['chunks']
+        gzip = self.current_page.get('gzip')
+        pieces = []
+        if start == 0 and stream:
+            pieces.extend(stream.header())
+        for i in xrange(start, len(chunks)):
+            chunk = chunks[i]
+            if i % 2:
+                # A fragment's deferred fires before the elements it needs
+                # have, so wait until the element itself has arrived
+                d = deferreds.get(tag_keys.get(i))
+                if d:
+                    self.unloadElements()
+                    self.writeStream(connection, pieces, chunked)
+                    d.addCallback(self.streamChunks, connection, request, elements, tag_keys, deferreds, i, stream, chunked)
+                    d.addErrback(self.streamFailed, connection, request, chunked)
+                    return
+                chunk = self.specialize(chunk)
+                if stream:
+                    pieces.extend(stream.plain(chunk))
+                else:
+                    pieces.append(chunk)
+            elif chunk and stream:
+                pieces.extend(stream.compressed(chunk, gzip[i]))
+            else:
+                pieces.append(chunk)
+        self.unloadElements()
+        if stream:
+            pieces.extend(stream.trailer())
+        self.writeStream(connection, pieces, chunked)
+        if chunked:
+            connection.transport.write('0\r\n\r\n')
+        connection.shutdown()
+        self.finishRequest(request, 'streamed')
+        log.msg('RENDER [%s] (%.3fs after request received, streamed)' % (request.uri, (time.time() - request.received_on)))
+        
+    def streamFailed(self, reason, connection, request, chunked):
+        "The head has gone out already, so end the response where it is"
+        self.unloadElements()
+        self.getError(reason)
+        if chunked:
+            connection.transport.write('0\r\n\r\n')
+        connection.shutdown()
+        self.finishRequest(request, 'failed')
+        
+    def writeStream(self, connection, pieces, chunked):
+        pieces = [piece for piece in pieces if piece]
+        if not pieces:
+            return
+        if chunked:
+            size = sum([len(piece) for piece in pieces])
+            connection.transport.writeSequence(['%x\r\n' % size] + pieces + ['\r\n'])
+        else:
+            connection.transport.writeSequence(pieces)
+            
+    def getError(self, reason):
+        log.msg('ERROR: Could not render page: %s' % reason.getErrorMessage())
+        reason.printTraceback()
+
+    def finishRequest(self, request, kind):
+        "Aggregate the request's phase timings"
+        request.mark('write')
+        metrics = self.store.metrics
+        metrics.incr('requests_' + kind)
+        for phase in request.phases:
+            metrics.timing('phase_' + phase, request.timings[phase])
+        metrics.timing('request', time.time() - request.received_on)
+        
+    def timingHeader(self, connection, request):
+        "Phase timings so far, for clients allowed to see them"
+        name = self.config.get('timing_header')
+        if name and self.allowed(connection, request):
+            return '%s: %s\r\n' % (name, request.writeTimings())
+        return ''
+
+    def rangeCurrent(self, request, page):
+        "Does an If-Range header (if any) still describe the page?"
+        condition = request.getHeader('if-range')
+        if not condition:
+            return True
+        if condition.startswith('"'):
+            return condition == page.get('etag')
+        return condition == page.get('last_modified')
+
+    def sendRanges(self, connection, request, page, ranges):
+        "Answer a Range request from the uncompressed body of a template-free page"
+        body = page['chunks'][0]
+        length = len(body)
+        head = page['head'] + self.timingHeader(connection, request)
+        headers = head[head.index('\r\n') + 2:]
+        protocol = page['response'].protocol
+        if not ranges:
+            status = 416
+            headers += 'content-range: bytes */%s\r\n' % length
+            parts = []
+        elif len(ranges) == 1:
+            status = 206
+            first, last = ranges[0]
+            headers += 'content-range: bytes %s-%s/%s\r\n' % (first, last, length)
+            parts = [body[first:last + 1]]
+        else:
+            status = 206
+            # Each part carries the page's content type
+            boundary = '%016x' % random.getrandbits(64)
+            content_type = page['response'].getHeader('content-type')
+            parts = []
+            for first, last in ranges:
+                part = '\r\n--%s\r\n' % boundary
+                if content_type:
+                    part += 'content-type: %s\r\n' % content_type
+                part += 'content-range: bytes %s-%s/%s\r\n\r\n' % (first, last, length)
+                parts.extend([part, body[first:last + 1]])
+            parts.append('\r\n--%s--\r\n' % boundary)
+            headers = ''.join([line + '\r\n' for line in headers.split('\r\n') if line and not line.startswith('content-type:')])
+            headers += 'content-type: multipart/byteranges; boundary=%s\r\n' % boundary
+        output = ['%s %s %s\r\n' % (protocol, status, http.messages[status]), headers,
+            'content-length: %s\r\n\r\n' % sum([len(part) for part in parts])]
+        if request.method.upper() != 'HEAD':
+            output.extend(parts)
+        connection.transport.writeSequence(output)
+        connection.shutdown()
+        self.finishRequest(request, status == 206 and 'partial' or 'unsatisfiable')
+        log.msg('RANGE [%s] (%s, %.3fs after request received)' % (request.uri, ranges, time.time() - request.received_on))
+
+    def notModified(self, request, page, gzip = False):
+        "Does the client already hold this version of the page?"
+        if request.method.upper() not in ['GET', 'HEAD'] or page['response'].status != 200:
+            return False
+        match = request.getHeader('if-none-match')
+        if match:
+            etag = page.get(gzip and 'gzip_etag' or 'etag')
+            tags = [tag.strip().replace('W/', '') for tag in match.split(',')]
+            return etag is not None and ('*' in tags or etag.replace('W/', '') in tags)
+        since = http.parseDate(request.getHeader('if-modified-since'))
+        modified = http.parseDate(page.get('last_modified'))
+        return since is not None and modified is not None and since >= modified
+
+# ---------- ADMIN -----------
+
+    def allowed(self, connection, request):
+        "Is the client on the admin allow-list?"
+        hosts = [connection.transport.getPeer().host]
+        if request.getHeader('x-real-ip'):
+            hosts.append(request.getHeader('x-real-ip'))
+        return not [True for host in hosts if host not in self.admin_clients]
+
+    def admin(self, connection, request):
+        "Serve requests for the admin interface"
+        if not self.allowed(connection, request):
+            connection.sendCode(403)
+            return
+        parts = urlparse.urlparse(request.uri)
+        command = parts[2][len(self.admin_path):].strip('/')
+        args = urlparse.parse_qs(parts[4])
+        if command == 'metrics':
+            connection.sendCode(200, self.store.metrics.report())
+        elif command == 'profile':
+            try:
+                seconds = float(args.get('seconds', ['10'])[0])
+            except ValueError:
+                seconds = 0
+            # Rejects nan and inf as well
+            if not 0 < seconds < float('inf'):
+                connection.sendCode(400, 'seconds must be a positive number\n')
+                return
+            seconds = min(seconds, self.profile_max_seconds)
+            self.profile(connection, seconds)
+        elif command == 'hot':
+            try:
+                count = int(args.get('count', ['20'])[0])
+            except ValueError:
+                count = -1
+            if count < 0:
+                connection.sendCode(400, 'count must be a whole number\n')
+                return
+            connection.sendCode(200, self.store.analytics.report(count))
+        else:
+            connection.sendCode(404)
+            
+    def profile(self, connection, seconds):
+        "Profile the live process for a number of seconds and report the result"
+        if self.profiler:
+            connection.sendCode(503, 'A profile is already running\n')
+            return
+        import cProfile
+        log.msg('PROFILE: Recording %.1fs' % seconds)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        reactor.callLater(seconds, self.profileDone, connection)
+        
+    def profileDone(self, connection):
+        import pstats, StringIO
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        filename = os.path.join(self.config.get('profile_dir', '/tmp'), 'twice-%s-%d.prof' % (os.getpid(), time.time()))
+        profiler.dump_stats(filename)
+        log.msg('PROFILE: Saved to %s' % filename)
+        output = StringIO.StringIO()
+        output.write('Saved to %s\n\n' % filename)
+        pstats.Stats(profiler, stream = output).sort_stats('cumulative').print_stats(40)
+        connection.sendCode(200, output.getvalue())
+
 # ---------- TEMPLATING -----------
 
     def specialize(self, expression):
         "Parse an expression and return the result"
         try:
-            expression = expression.groups()[0].strip()
+            expression = expression.strip()
             parts = expression.split()
             # Syntax is: command target arg1 arg2 argn
-            #   command - one of 'get', 'if', 'unless', 'incr', 'decr'
-            #   target - one of 'memcache', 'session'
+            #   command - one of 'get', 'if', 'unless', 'incr', 'decr', 'include'
+            #   target - one of 'memcache', 'session', 'page'
             #   arg[n] - usually the name of a key
             command, target, args = parts[0].lower(), parts[1], parts[2:]
             #log.msg('command: %s target: %s args: %s' % (command, target, repr(args)))
@@ -201,7 +579,28 @@ class RequestHandler(http.HTTPRequestDispatcher):
             dictionary = {}
         #log.msg('dictionary: %s' % dictionary)
         # Handle commands
-        if command == 'get' and len(args) >= 1:
+        if command == 'include' and len(args) >= 1:
+            if self.including:
+                # Only pages include fragments, so an include can never recurse
+                log.msg('Nested include ignored: [%s]' % expression)
+                return ''
+            fragment = self.current_fragment.get(args[0])
+            if not fragment or fragment['response'].status != 200:
+                return ''
+            if 'chunks' not in fragment:
+                self.store.prepare_page(fragment)
+            # Tags inside the fragment see the elements loaded for the page
+            pieces = []
+            self.including = True
+            try:
+                for i, chunk in enumerate(fragment['chunks']):
+                    if i % 2:
+                        chunk = self.specialize(chunk)
+                    pieces.append(chunk)
+            finally:
+                self.including = False
+            return ''.join(pieces)
+        elif command == 'get' and len(args) >= 1:
             if len(args) >= 2:
                 default = args[1]
             else:
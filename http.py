@@ -12,12 +12,17 @@
 
 from twisted.python import log
 from twisted.protocols import basic
-from twisted.internet import protocol, defer
-import traceback, urllib, time
+from twisted.internet import protocol, defer, reactor, error
+import traceback, urllib, time, email.utils
 
 messages = {
     200 : 'OK',
+    206 : 'Partial Content',
+    304 : 'Not Modified',
     400 : 'Bad Request',
+    403 : 'Forbidden',
+    404 : 'Not Found',
+    416 : 'Requested Range Not Satisfiable',
     500 : 'Internal Server Error',
     501 : 'Not Implemented',
     502 : 'Bad Gateway',
@@ -26,6 +31,42 @@ messages = {
     505 : 'HTTP Version Not Supported',
 }
 
+def parseDate(value):
+    "Seconds since the epoch for an HTTP date, or None"
+    try:
+        return email.utils.mktime_tz(email.utils.parsedate_tz(value))
+    except:
+        return None
+
+def parseRange(value, length):
+    "Inclusive byte ranges asked for by a Range header: [] if none can be satisfied, None to ignore the header"
+    if not value or not value.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    try:
+        for spec in value.split('=', 1)[1].split(','):
+            spec = spec.strip()
+            if not spec:
+                continue
+            first, last = spec.split('-')
+            if not first:
+                # The last n bytes
+                if int(last) > 0 and length:
+                    ranges.append((max(length - int(last), 0), length - 1))
+                continue
+            first = int(first)
+            if last:
+                last = int(last)
+                if last < first:
+                    return None
+            else:
+                last = length - 1
+            if first < length:
+                ranges.append((first, min(last, length - 1)))
+    except ValueError:
+        return None
+    return ranges
+
 class HTTPObject:    
     
     def __init__(self, id=None):
@@ -45,6 +86,40 @@ class HTTPObject:
         self.dependencies = []
         self.elements = {}
         self.received_on = None
+        self.gzip = False
+        self.fragment = False
+        self.fragments = {}
+        # Seconds spent per phase, in the order the phases happened
+        self.timings = {}
+        self.phases = []
+        self.marked_on = None
+        
+    def mark(self, phase):
+        "Charge the time since the previous mark (or since the request arrived) to a phase"
+        now = time.time()
+        self.addTiming(phase, now - (self.marked_on or self.received_on or now), overlaps = False)
+        self.marked_on = now
+        
+    def addTiming(self, phase, seconds, overlaps = True):
+        "Record time spent in a phase; of overlapping ones, the longest counts"
+        if phase not in self.timings:
+            self.phases.append(phase)
+            self.timings[phase] = 0.0
+        if overlaps:
+            self.timings[phase] = max(self.timings[phase], seconds)
+        else:
+            self.timings[phase] += seconds
+            
+    def writeTimings(self):
+        return '; '.join(['%s=%.4f' % (phase, self.timings[phase]) for phase in self.phases])
+        
+    def copy(self):
+        "Copy with its own headers and cookies"
+        other = HTTPObject(self.id)
+        other.__dict__.update(self.__dict__)
+        other.headers = dict(self.headers)
+        other.cookies = list(self.cookies)
+        return other
         
     def setHeader(self, key, value=''):
         self.removeHeader(key)
@@ -67,6 +142,24 @@ class HTTPObject:
                         return int(val)
         return None
         
+    def acceptsEncoding(self, encoding):
+        "Parse headers looking like 'accept-encoding: gzip;q=1.0, identity'"
+        header = self.getHeader('accept-encoding')
+        if header:
+            for element in header.lower().split(','):
+                parts = [part.strip() for part in element.split(';')]
+                if parts[0] in [encoding, '*']:
+                    for param in parts[1:]:
+                        if '=' in param:
+                            key, val = param.split('=')[0:2]
+                            try:
+                                if key == 'q' and float(val) == 0:
+                                    return False
+                            except ValueError:
+                                pass
+                    return True
+        return False
+        
     def removeHeader(self, key):
         for k in list(self.headers.keys()):
             if key.lower() == k.lower():
@@ -109,6 +202,11 @@ class HTTPObject:
             cookie_data = 'cookie: %s\r\n' % ('; '.join(self.cookies))
         return cookie_data
         
+    def writeHead(self, exclude = []):
+        "Status line, headers and cookies of a response, without the closing blank line"
+        header_data = ''.join(['%s: %s\r\n' % (k,v) for k,v in self.headers.items() if k not in exclude])
+        return ''.join([self.writeStatus(), header_data, self.writeCookies('set-cookie')])
+
     def writeBody(self, body = None):
         self.setHeader('content-length', len(body or self.body))
 
@@ -116,6 +214,12 @@ class HTTPObject:
         self.writeBody(body or self.body)
         return ''.join([self.writeStatus(), self.writeHeaders(), self.writeCookies('set-cookie'), '\r\n', body or self.body])
 
+    def writeResponseSequence(self, pieces, head = None):
+        "Serialize a response as a list of strings for transport.writeSequence"
+        length = sum([len(piece) for piece in pieces])
+        head = head or self.writeHead(exclude = ['content-length'])
+        return [head, 'content-length: %s\r\n\r\n' % length] + pieces
+
     def writeRequest(self, body = None):
         self.writeBody()
         return ''.join([self.writeCommand(), self.writeHeaders(), self.writeCookies('cookie'), '\r\n', body or self.body])
@@ -123,15 +227,87 @@ class HTTPObject:
         
 class HTTPHandler(basic.LineReceiver):
 
+    methods = ['GET', 'PUT', 'POST', 'DELETE', 'HEAD']
+
     def __init__(self):
         self.max_headers = 100
         self.object_count = 0
         self.object = None 
         self.received_on = None
+        self.buffer = ''
+        self.length = 0
         
     def connectionMade(self):
         self.received_on = time.time()       
         
+    def dataReceived(self, data):
+        "Parse a line at a time, or whole header blocks when the factory is buffered"
+        if not self.factory.buffered:
+            return basic.LineReceiver.dataReceived(self, data)
+        self.buffer += data
+        while self.buffer and not self.transport.disconnecting:
+            if self.object:
+                # Body of the current object
+                needed = self.length - len(self.object.body)
+                self.object.body += self.buffer[:needed]
+                self.buffer = self.buffer[needed:]
+                if len(self.object.body) < self.length:
+                    return
+                self.factory.objectReceived(self, self.object)
+                self.object = None
+                continue
+            self.buffer = self.buffer.lstrip('\r\n')
+            end = self.buffer.find('\r\n\r\n')
+            if end == -1:
+                if len(self.buffer) > self.MAX_LENGTH:
+                    self.badRequest('Header block too long')
+                return
+            head = self.buffer[:end]
+            self.buffer = self.buffer[end + 4:]
+            self.headReceived(head)
+            
+    def headReceived(self, head):
+        "Parse the status line and headers of an object in one pass"
+        self.object = HTTPObject(self.object_count)
+        self.object.received_on = self.received_on
+        self.object_count += 1
+        lines = head.split('\r\n')
+        try:
+            parts = lines[0].split()
+            if parts[0].upper() in self.methods:
+                self.object.method, self.object.uri, self.object.protocol = parts
+            else:
+                self.object.protocol = parts[0]
+                self.object.status = int(parts[1])
+                self.object.message = ' '.join(parts[2:])
+            headers = self.object.headers
+            for line in lines[1:]:
+                key, value = line.split(': ')
+                key = key.lower()
+                if key == 'cookie':
+                    self.object.cookies.extend(value.split('; '))
+                elif key == 'set-cookie':
+                    self.object.cookies.append(value)
+                else:
+                    headers[key] = value
+            self.length = int(headers.get('content-length') or 0)
+            if self.length > 0:
+                self.object.mode = 'body'
+                return
+        except:
+            self.badRequest(lines[0])
+            return
+        self.factory.objectReceived(self, self.object)
+        self.object = None
+        
+    def badRequest(self, line):
+        log.msg("Bad line was: %s" % line)
+        try:
+            self.sendCode(400)
+        except:
+            pass
+        self.shutdown()
+        
     def lineReceived(self, line):
         if not self.object:
             self.object = HTTPObject(self.object_count)
@@ -140,7 +316,7 @@ class HTTPHandler(basic.LineReceiver):
         if self.object.mode == 'status':
             try:
                 parts = line.split()
-                if parts[0].upper() in ['GET', 'PUT', 'POST', 'DELETE', 'HEAD']:
+                if parts[0].upper() in self.methods:
                     self.object.method, self.object.uri, self.object.protocol = parts
                     self.object.uri = self.object.uri
                 else:
@@ -199,6 +375,13 @@ class HTTPServer(HTTPHandler):
     def __init__(self):
         HTTPHandler.__init__(self)
         
+    def connectionMade(self):
+        HTTPHandler.connectionMade(self)
+        self.factory.connections += 1
+        
+    def connectionLost(self, reason):
+        self.factory.connections -= 1
+        
     def sendCode(self, code, body = ''):
         response = HTTPObject()
         response.status = int(code)
@@ -212,12 +395,15 @@ class HTTPClient(HTTPHandler):
         HTTPHandler.__init__(self)
     
     def connectionMade(self):
+        self.factory.connection = self
         data = self.factory.request.writeRequest()
         self.transport.write(data)
         
 class HTTPRequestDispatcher(protocol.ServerFactory):
     
     protocol = HTTPServer
+    connections = 0
+    buffered = False
         
     def objectReceived(self, connection, request):
         "Override me"
@@ -225,14 +411,44 @@ class HTTPRequestDispatcher(protocol.ServerFactory):
 class HTTPRequestSender(protocol.ClientFactory):
     
     protocol = HTTPClient
+    buffered = False
     
-    def __init__(self, request):
+    def __init__(self, request, timeout = None):
         self.request = request
         self.deferred = defer.Deferred()
+        self.connection = None
+        self.timeout = None
+        if timeout:
+            self.timeout = reactor.callLater(timeout, self.timedOut)
         
     def __repr__(self):
         return '<HTTPRequestSender (%s)>' % self.request.uri
     
     def objectReceived(self, connection, response):
         "Send the page!"
-        self.deferred.callback(response)
+        if not self.deferred.called:
+            self.finish()
+            self.deferred.callback(response)
+            
+    def clientConnectionFailed(self, connector, reason):
+        if not self.deferred.called:
+            self.finish()
+            self.deferred.errback(reason)
+            
+    def clientConnectionLost(self, connector, reason):
+        "The server hung up before sending a complete response"
+        if not self.deferred.called:
+            self.finish()
+            self.deferred.errback(reason)
+            
+    def timedOut(self):
+        self.timeout = None
+        if not self.deferred.called:
+            self.deferred.errback(error.TimeoutError('No response for %s' % self.request.uri))
+        if self.connection:
+            self.connection.shutdown()
+            
+    def finish(self):
+        if self.timeout:
+            self.timeout.cancel()
+            self.timeout = None
@@ -0,0 +1,45 @@
+"""
+
+    File: metrics.py
+    Description: 
+    
+        Counters, gauges and timing aggregates, reported through the admin 
+        interface.
+    
+"""
+
+import time
+
+class Metrics:
+    "In-process metrics that are cheap enough to update on every request"
+    
+    def __init__(self):
+        self.started_on = time.time()
+        self.counters = {}
+        self.gauges = {}
+        # name -> [count, total seconds, max seconds]
+        self.timings = {}
+        
+    def incr(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        
+    def timing(self, name, seconds):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        
+    def report(self):
+        "Plain text report, one metric per line"
+        lines = ['uptime %.0f' % (time.time() - self.started_on)]
+        for name in sorted(self.counters.keys()):
+            lines.append('%s %s' % (name, self.counters[name]))
+        for name in sorted(self.gauges.keys()):
+            lines.append('%s %s' % (name, self.gauges[name]))
+        for name in sorted(self.timings.keys()):
+            count, total, peak = self.timings[name]
+            lines.append('%s count=%s avg=%.6f max=%.6f' % (name, count, total / count, peak))
+        return '\n'.join(lines) + '\n'
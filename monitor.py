@@ -0,0 +1,105 @@
+"""
+
+    File: monitor.py
+    Description: 
+    
+        Resource monitor.  Keeps an eye on memory, cpu, file descriptors and
+        event loop lag, and backs off in steps as Twice nears its limits.
+    
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+import os, time, resource, traceback
+
+class ResourceMonitor:
+    "Samples process resources on a timer and sheds cache, then connections, as usage grows"
+    
+    def __init__(self, config, factory, restarter):
+        self.factory = factory
+        self.restarter = restarter
+        self.store = factory.store
+        self.metrics = self.store.metrics
+        # Limits and thresholds (fractions of the limits)
+        self.memory_limit = float(config.get('memory_limit', 100))
+        self.evict_level = float(config.get('memory_evict_level', 0.8))
+        self.refuse_level = float(config.get('memory_refuse_level', 0.9))
+        self.fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        self.interval = float(config.get('monitor_interval', 0.5))
+        self.evict_interval = float(config.get('monitor_evict_interval', 10))
+        # State
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.cpu_time = None
+        self.evicted_on = 0
+        self.check()
+        
+    def check(self, scheduled = None):
+        "Take a sample and respond to it"
+        now = time.time()
+        if scheduled:
+            self.store.loop_lag = max(0.0, now - scheduled)
+            self.metrics.gauge('loop_lag', '%.4f' % self.store.loop_lag)
+        try:
+            memory = self.memory()
+            fds = self.fds()
+            self.metrics.gauge('memory_mb', '%.2f' % memory)
+            self.metrics.gauge('cpu_percent', '%.1f' % self.cpu(now))
+            self.metrics.gauge('fds', fds)
+            self.metrics.gauge('fd_limit', self.fd_limit)
+            self.metrics.gauge('connections', self.factory.connections)
+            self.respond(max(memory / self.memory_limit, fds / float(self.fd_limit)))
+        except:
+            log.msg('Unable to read resource usage!')
+            traceback.print_exc()
+        reactor.callLater(self.interval, self.check, now + self.interval)
+        
+    def memory(self):
+        "Resident memory in MB"
+        try:
+            resident = int(open('/proc/self/statm').read().split()[1])
+            return resident * self.page_size / 1048576.0
+        except IOError:
+            # No /proc, settle for the peak
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            
+    def cpu(self, now):
+        "Percent cpu used since the previous sample"
+        try:
+            data = open('/proc/self/stat').read()
+            fields = data[data.rindex(')') + 2:].split()
+            used = (int(fields[11]) + int(fields[12])) / float(self.clock_ticks)
+        except IOError:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = usage.ru_utime + usage.ru_stime
+        previous, self.cpu_time = self.cpu_time, (now, used)
+        if not previous or now <= previous[0]:
+            return 0.0
+        return 100.0 * (used - previous[1]) / (now - previous[0])
+        
+    def fds(self):
+        "Open file descriptors"
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return 0
+            
+    def respond(self, usage):
+        "Back off in steps: evict cache, refuse cache sets, then drain and restart"
+        self.metrics.gauge('resource_usage', '%.3f' % usage)
+        if usage >= 1.0:
+            if not self.restarter.draining and not self.restarter.child:
+                log.msg('Resource usage at %.0f%% of limits, restarting' % (usage * 100))
+                self.restarter.restart()
+            return
+        if usage >= self.refuse_level and self.store.accept_sets:
+            log.msg('Resource usage at %.0f%% of limits, refusing cache sets' % (usage * 100))
+            self.store.accept_sets = False
+        elif usage < self.refuse_level and not self.store.accept_sets:
+            log.msg('Resource usage at %.0f%% of limits, accepting cache sets' % (usage * 100))
+            self.store.accept_sets = True
+        if usage >= self.evict_level and time.time() - self.evicted_on > self.evict_interval:
+            log.msg('Resource usage at %.0f%% of limits, evicting' % (usage * 100))
+            self.evicted_on = time.time()
+            self.metrics.incr('evictions')
+            self.store.shrink()
@@ -0,0 +1,103 @@
+"""
+
+    File: providers.py
+    Description:
+
+        Sources of template elements.  Each provider handles one element
+        type and fetches the elements it is missing in batches.
+
+"""
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+import time
+
+def load(path, store):
+    "Instantiate a provider from a 'module.Class' path"
+    module, name = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [name]), name)(store)
+
+class Provider:
+    "Override name and fetch_many, and the rest as needed"
+
+    # Element type, also the prefix of its cache keys
+    name = None
+    # Seconds to keep fetched elements in the cache
+    ttl = 30
+    # Whether visitors without a session get the element
+    anonymous = False
+
+    def __init__(self, store):
+        self.store = store
+        # id -> deferreds waiting for the next batch, or for the batch in flight
+        self.waiting = {}
+        self.fetching = {}
+        self.call = None
+
+    def hash(self, request, id):
+        "Cache key of an element"
+        return '%s_%s' % (self.name, id)
+
+    def valid(self, request, id, value):
+        "Can a cached element still be used?"
+        return True
+
+    def fetch_many(self, ids):
+        "Override me: return a dict (or a deferred firing with one) of id -> element"
+        return {}
+
+    def get(self, request, id, stale = None):
+        "Deferred element, fetched together with every other one asked for during this pass of the event loop"
+        d = defer.Deferred()
+        if id in self.fetching:
+            self.fetching[id].append(d)
+            return d
+        if id not in self.waiting:
+            self.waiting[id] = []
+            if self.call is None:
+                self.call = reactor.callLater(0, self.flush)
+        self.waiting[id].append(d)
+        return d
+
+    def flush(self):
+        self.call = None
+        batch, self.waiting = self.waiting, {}
+        self.fetching.update(batch)
+        log.msg('FETCH-MANY [%s] (%s elements)' % (self.name, len(batch)))
+        self.store.metrics.incr('batches_' + self.name)
+        self.store.metrics.incr('batched_' + self.name, len(batch))
+        d = defer.maybeDeferred(self.fetch_many, batch.keys())
+        d.addCallback(self.received, batch.keys(), time.time())
+        d.addErrback(self.failed, batch.keys())
+        d.addCallback(self.deliver, batch.keys())
+
+    def received(self, values, ids, started):
+        self.store.metrics.timing('fetch_many_' + self.name, time.time() - started)
+        # Ids the provider didn't return stay misses
+        found = dict([(self.name + '_' + id, values[id]) for id in ids if values.get(id) is not None])
+        if found and self.store.accept_sets:
+            self.store.cache.set(found, self.ttl)
+        return values
+
+    def failed(self, reason, ids):
+        log.msg('ERROR: Could not fetch %s %s: %s' % (self.name, ids, reason.getErrorMessage()))
+        return {}
+
+    def deliver(self, values, ids):
+        for id in ids:
+            for d in self.fetching.pop(id, []):
+                d.callback(values.get(id))
+
+class MemcacheProvider(Provider):
+    "Values from the application's memcache, by key"
+
+    name = 'memcache'
+    ttl = 30
+    anonymous = True
+
+    def fetch_many(self, ids):
+        log.msg('Looking up memcache %s' % ids)
+        return self.store.proto.get_multi(ids).addCallback(self.extract)
+
+    def extract(self, results):
+        return results[1]
@@ -0,0 +1,130 @@
+"""
+
+    File: purge.py
+    Description:
+
+        Forwards cache purges to the other Twice nodes in a fleet.
+
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+import http
+
+class PurgeError(Exception):
+    "A peer did not accept a batch of purges"
+
+class Peer:
+    "Purges waiting to be sent to one Twice node, de-duplicated and in order"
+
+    def __init__(self, address):
+        try:
+            self.host, self.port = address.split(':')
+            self.port = int(self.port)
+        except ValueError:
+            self.host, self.port = address, 80
+        self.name = '%s:%s' % (self.host, self.port)
+        self.pending = []
+        self.queued = {}
+        self.sending = None
+        self.call = None
+        self.failures = 0
+
+    def add(self, purge):
+        if purge not in self.queued:
+            self.queued[purge] = True
+            self.pending.append(purge)
+
+    def take(self, count):
+        batch, self.pending = self.pending[:count], self.pending[count:]
+        for purge in batch:
+            del self.queued[purge]
+        return batch
+
+    def clear(self):
+        self.pending = []
+        self.queued = {}
+
+class PurgeFanout:
+    "Sends purges to peers in batches, in the background, retrying until they are delivered"
+
+    def __init__(self, config, metrics):
+        self.config = config
+        self.metrics = metrics
+        self.peers = [Peer(address.strip()) for address in (config.get('purge_peers') or '').split(',') if address.strip()]
+        self.purge_header = config.get('purge_header')
+        self.delay = float(config.get('purge_batch_delay', 0.1))
+        self.batch_size = int(config.get('purge_batch_size', 100))
+        self.queue_limit = int(config.get('purge_queue_limit', 10000))
+        self.timeout = float(config.get('purge_timeout', 5))
+        self.retry_max = float(config.get('purge_retry_max', 30))
+        if self.peers:
+            log.msg('Forwarding purges to %s' % ', '.join([peer.name for peer in self.peers]))
+
+    def enqueue(self, kind, uri):
+        "Queue a purge for every peer; returns immediately"
+        for peer in self.peers:
+            purge = (kind, uri)
+            if kind == '*':
+                # A full flush supersedes everything queued before it
+                peer.clear()
+            elif len(peer.pending) >= self.queue_limit:
+                # Never drop a purge: fall back to flushing the peer entirely
+                log.msg('PURGE-OVERFLOW [%s] (%s queued, sending a full flush instead)' % (peer.name, len(peer.pending)))
+                self.metrics.incr('purge_overflow')
+                peer.clear()
+                purge = ('*', '/')
+            peer.add(purge)
+            self.schedule(peer, self.delay)
+        self.report()
+
+    def schedule(self, peer, delay):
+        if peer.call is None and peer.sending is None:
+            peer.call = reactor.callLater(delay, self.send, peer)
+
+    def send(self, peer):
+        "Send the next batch to a peer, one request in flight at a time"
+        peer.call = None
+        batch = peer.take(self.batch_size)
+        if not batch:
+            return
+        request = http.HTTPObject()
+        request.method = 'POST'
+        request.uri = '/'
+        request.setHeader('host', peer.name)
+        request.setHeader(self.purge_header, 'batch')
+        request.body = ''.join(['%s %s\n' % purge for purge in batch])
+        sender = http.HTTPRequestSender(request, self.timeout)
+        sender.noisy = False
+        peer.sending = batch
+        reactor.connectTCP(peer.host, peer.port, sender, timeout = self.timeout)
+        sender.deferred.addCallback(self.sent, peer)
+        sender.deferred.addErrback(self.failed, peer)
+
+    def sent(self, response, peer):
+        if response.status != 200:
+            raise PurgeError('%s returned %s' % (peer.name, response.status))
+        self.metrics.incr('purge_sent', len(peer.sending))
+        peer.sending = None
+        peer.failures = 0
+        if peer.pending:
+            self.schedule(peer, 0)
+        self.report()
+
+    def failed(self, reason, peer):
+        "Put the batch back in front of anything queued since, and try again later"
+        batch, peer.sending = peer.sending, None
+        if not [True for purge in peer.pending if purge[0] == '*']:
+            later = peer.pending
+            peer.clear()
+            for purge in batch + later:
+                peer.add(purge)
+        peer.failures += 1
+        delay = min(self.delay * 2 ** peer.failures, self.retry_max)
+        log.msg('PURGE-RETRY [%s] (%s purges, again in %.1fs): %s' % (peer.name, len(peer.pending), delay, reason.getErrorMessage()))
+        self.metrics.incr('purge_failed')
+        self.schedule(peer, delay)
+        self.report()
+
+    def report(self):
+        self.metrics.gauge('purge_queue', sum([len(peer.pending) for peer in self.peers]))
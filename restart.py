@@ -0,0 +1,139 @@
+"""
+
+    File: restart.py
+    Description: 
+    
+        Graceful restarts.  The listening socket is handed to a fresh Twice 
+        process (which reads the config file again) while this one finishes 
+        the requests it has in flight.
+    
+"""
+
+from twisted.python import log
+import os, sys, time, signal, fcntl, errno, resource, traceback
+
+# Environment variables that tell a new process which fd to listen on, and 
+# which fd to report on once it is listening.  The reactor is imported where
+# it's used, so that twice.py can read these before installing its reactor.
+LISTEN_FD = 'TWICE_LISTEN_FD'
+READY_FD = 'TWICE_READY_FD'
+
+def ready(fd):
+    "Tell the process that started us that we are accepting connections"
+    os.write(int(fd), 'R')
+    os.close(int(fd))
+
+class Restarter:
+    "Restarts Twice on SIGHUP or SIGUSR2 without refusing a single connection"
+    
+    def __init__(self, config, factory, port):
+        self.factory = factory
+        self.port = port
+        self.drain_timeout = float(config.get('drain_timeout', 30))
+        self.ready_timeout = float(config.get('restart_timeout', 30))
+        self.draining = False
+        # Pid and readiness pipe of a new process that isn't listening yet
+        self.child = None
+        for signum in [signal.SIGHUP, signal.SIGUSR2]:
+            signal.signal(signum, self.signalled)
+            
+    def signalled(self, signum, frame):
+        from twisted.internet import reactor
+        reactor.callFromThread(self.restart)
+        
+    def restart(self):
+        "Start the new process; once it is listening, stop accepting connections and drain"
+        if self.draining or self.child:
+            return
+        log.msg('Restarting: handing off the listening socket')
+        try:
+            self.child = self.spawn()
+        except:
+            log.msg('Unable to start a new process, still serving')
+            traceback.print_exc()
+            return
+        self.ready_by = time.time() + self.ready_timeout
+        self.checkReady()
+        
+    def spawn(self):
+        "Fork and exec a new process that inherits only stdio, the listening socket and the readiness pipe"
+        fd = self.port.fileno()
+        reader, writer = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FD] = str(fd)
+        env[READY_FD] = str(writer)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                keep = sorted([fd, writer])
+                limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+                os.closerange(3, keep[0])
+                os.closerange(keep[0] + 1, keep[1])
+                os.closerange(keep[1] + 1, limit)
+                for kept in keep:
+                    flags = fcntl.fcntl(kept, fcntl.F_GETFD)
+                    fcntl.fcntl(kept, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+                os.execve(sys.executable, [sys.executable] + sys.argv, env)
+            finally:
+                os._exit(1)
+        os.close(writer)
+        fcntl.fcntl(reader, fcntl.F_SETFL, fcntl.fcntl(reader, fcntl.F_GETFL) | os.O_NONBLOCK)
+        log.msg('Started process %s' % pid)
+        return pid, reader
+        
+    def checkReady(self):
+        "Hand over once the new process is listening; keep serving if it fails"
+        from twisted.internet import reactor
+        pid, reader = self.child
+        try:
+            data = os.read(reader, 1)
+        except OSError, e:
+            # Nothing to read yet, unless the pipe itself is broken
+            data = e.errno != errno.EAGAIN and '' or None
+        if data:
+            os.close(reader)
+            self.child = None
+            log.msg('Process %s is listening, draining' % pid)
+            self.drain()
+        elif data == '' or os.waitpid(pid, os.WNOHANG)[0]:
+            # The pipe closed (or the process exited) without a word
+            os.close(reader)
+            self.child = None
+            self.reap(pid)
+            log.msg('Process %s failed to start, still serving' % pid)
+        elif time.time() > self.ready_by:
+            os.close(reader)
+            self.child = None
+            log.msg('Process %s did not start listening in %.0fs, killing it and still serving' % (pid, self.ready_timeout))
+            os.kill(pid, signal.SIGKILL)
+            self.reap(pid)
+        else:
+            reactor.callLater(0.1, self.checkReady)
+            
+    def reap(self, pid):
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        
+    def drain(self):
+        self.draining = True
+        self.deadline = time.time() + self.drain_timeout
+        # The new process holds its own copy of the socket, so nothing is refused
+        self.port.stopListening()
+        self.checkDrained()
+        
+    def busy(self):
+        "Connections, backend work and queued refreshes still in flight"
+        store = self.factory.store
+        return self.factory.connections + store.limiter.active + store.limiter.depth() + \
+            store.db_limiter.active + store.db_limiter.depth()
+            
+    def checkDrained(self):
+        from twisted.internet import reactor
+        busy = self.busy()
+        if busy <= 0 or time.time() > self.deadline:
+            log.msg('Drained (%s requests left), exiting' % busy)
+            reactor.stop()
+        else:
+            reactor.callLater(0.5, self.checkDrained)
@@ -1,22 +1,10 @@
-import sys, os, signal, traceback, resource
+import sys, os, socket, traceback, resource
 
 __author__    = "Kyle Vogt <kyleavogt@gmail.com> and Emmett Shear <emmett.shear@gmail.com>"
 __version__   = "0.2"
 __copyright__ = "Copyright (c) 2008, Justin.tv, Inc."
 __license__   = "MIT"        
 
-def check_memory(limit):
-    try:
-        cpu, mem = [i.replace('\n', '') for i in os.popen('ps -p %s -o pcpu,rss' % os.getpid()).readlines()[1].split(' ') if i]
-        real = int(mem) / 1000.0
-        if real > limit:
-            log.msg('Using too much memory (%.2fMB out of %.2fMB)' % (real, limit))
-            os.kill(os.getpid(), signal.SIGTERM)
-    except:
-        log.msg('Unable to read memory or cpu usage!')
-        traceback.print_exc()
-    reactor.callLater(15.0, check_memory, limit)
-    
 if __name__ == '__main__':
 
     # Read config
@@ -25,9 +13,11 @@ if __name__ == '__main__':
     
     # Log
     from twisted.python import log
+    import restart
     f = config['log']
     if f != 'stdout':
-        log.startLogging(open(f, 'w'))
+        # Keep the log of the process we are taking over from
+        log.startLogging(open(f, restart.LISTEN_FD in os.environ and 'a' or 'w'))
     else:
         log.startLogging(sys.stdout)
 
@@ -58,13 +48,28 @@ if __name__ == '__main__':
         log.msg('Error setting fd limit!')
         traceback.print_exc()
         
-    # Check memory usage
-    check_memory(int(config.get('memory_limit', 100)))
-        
     # Start request handler event loop
     import handler
     factory = handler.RequestHandler(config)
-    reactor.listenTCP(int(config['port']), factory)
+    listen_fd = os.environ.pop(restart.LISTEN_FD, None)
+    if listen_fd:
+        port = reactor.adoptStreamPort(int(listen_fd), socket.AF_INET, factory)
+        os.close(int(listen_fd))
+        log.msg('Took over listening socket from the previous process')
+    else:
+        port = reactor.listenTCP(int(config['port']), factory)
+    
+    # Restart gracefully on SIGHUP or SIGUSR2
+    restarter = restart.Restarter(config, factory, port)
+    
+    # Watch resource usage
+    import monitor
+    watchdog = monitor.ResourceMonitor(config, factory, restarter)
+    
+    # Let the process we are taking over from stop listening
+    ready_fd = os.environ.pop(restart.READY_FD, None)
+    if ready_fd:
+        restart.ready(ready_fd)
     
     #from twisted.manhole import telnet
     #shell = telnet.ShellFactory()